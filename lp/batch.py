@@ -0,0 +1,84 @@
+"""
+Solving lots of screenshots at once, across a pool of worker processes that
+each only have to load word lists and letter templates once.
+"""
+
+from functools import partial
+import glob
+import json
+from multiprocessing import Pool
+import os
+
+from lp.cache import get_solve_cache
+from lp.dictionary import get_dictionary
+from lp.game import Grid
+from lp.image import LPImageException
+
+
+def expand_paths(sources):
+    """
+    Yield the paths of every file in sources, which can be paths to files,
+    directories to look for files in, or glob patterns.
+    """
+
+    for source in sources:
+        if os.path.isdir(source):
+            for dirpath, dirnames, filenames in os.walk(source):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if not filename.startswith('.'):
+                        yield os.path.join(dirpath, filename)
+        elif glob.has_magic(source):
+            yield from sorted(glob.glob(source, recursive=True))
+        else:
+            yield source
+
+
+def prepare_worker():
+    # the letter templates got built when lp.image was imported, so this is
+    # all that's left to load
+    get_dictionary()
+
+
+def format_score(score):
+    if score == float('inf'):
+        return 'win'
+    elif score == -float('inf'):
+        return 'lose'
+    return score
+
+
+def solve(path, count=10):
+    """
+    Return a dictionary describing the grid in the screenshot at path and the
+    best count words to play on it, or the reason we couldn't read it.
+    """
+
+    try:
+        with open(path, 'rb') as image:
+            grid = Grid.from_image(image)
+    except (LPImageException, OSError) as e:
+        return {'path': path, 'error': str(e)}
+
+    return {
+        'path': path,
+        'letters': grid.letters,
+        'ownership': ''.join(t.ownership for t in grid.tiles),
+        'words': [
+            [word, format_score(score)]
+            for word, score in get_solve_cache().top_words(grid, count)
+        ],
+    }
+
+
+def solve_all(paths, workers=None, count=10):
+    """
+    Yield the result of solve() for each of paths as a line of JSON, in the
+    order they finish in.
+    """
+
+    with Pool(workers, initializer=prepare_worker) as pool:
+        for result in pool.imap_unordered(
+            partial(solve, count=count), paths,
+        ):
+            yield json.dumps(result)
@@ -0,0 +1,233 @@
+"""
+Timing the parts of lp that we spend the most time in.
+
+Usage:
+  python -m lp.benchmark [--repeat=REPEAT] [--grids=GRIDS] [--save=PATH]
+                         [--compare=PATH] [--tolerance=TOLERANCE]
+
+Reading screenshots is timed over every screenshot in lp/tests/images, both as
+it is and transcoded to JPEG. Solving is timed over the grids in those
+screenshots and GRIDS (by default 20) random grids. Each stage is run REPEAT
+times (by default 3), and the quickest run is the one we report.
+
+Results are printed as JSON, and written to PATH with --save. With --compare,
+they're also compared with the results saved at PATH, and any stage that's
+gotten more than TOLERANCE (by default 0.2, or 20%) slower is reported as a
+regression, in which case we exit with a status of 1.
+"""
+
+from io import BytesIO
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+from PIL import Image
+
+from lp.dictionary import ALPHABET, get_dictionary
+from lp.game import GRID_SIZE, NOBODY, OPPONENT, PLAYER, Grid
+from lp.image import (
+    LETTER_IMAGES, closest_letter, load_image, parse_image, top_of_grid,
+)
+
+
+IMAGE_DIR = os.path.join(os.path.dirname(__file__), 'tests', 'images')
+
+DEFAULT_REPEAT = 3
+DEFAULT_GRIDS = 20
+DEFAULT_TOLERANCE = 0.2
+# so that the random grids are the same every time
+SEED = 0
+
+# the lookahead priority always takes as long as its time budget allows, so
+# there's no point timing it
+PRIORITIES = [
+    p for p in Grid.PRIORITIES if p != Grid.LOOKAHEAD_PRIORITY
+]
+
+
+def screenshots():
+    """
+    Yield the contents of every screenshot of a game in IMAGE_DIR, as PNG and
+    transcoded to JPEG, along with which of those it is.
+    """
+
+    for dirpath, _, filenames in sorted(os.walk(IMAGE_DIR)):
+        for filename in sorted(filenames):
+            meta = filename if '_' in filename else os.path.basename(dirpath)
+
+            if filename.startswith('.') or not (
+                filename.endswith('.png') and '_' in meta
+            ):
+                continue
+
+            with open(os.path.join(dirpath, filename), 'rb') as f:
+                png = f.read()
+
+            jpeg = BytesIO()
+            Image.open(BytesIO(png)).convert('RGB').save(
+                jpeg, format='JPEG', quality=80,
+            )
+
+            yield 'png', png
+            yield 'jpeg', jpeg.getvalue()
+
+
+def random_grids(count, seed=SEED):
+    rng = random.Random(seed)
+
+    for _ in range(count):
+        yield (
+            ''.join(rng.choice(ALPHABET) for _ in range(GRID_SIZE ** 2)),
+            ''.join(
+                rng.choice((NOBODY, OPPONENT, PLAYER))
+                for _ in range(GRID_SIZE ** 2)
+            ),
+        )
+
+
+def time_stage(fn, inputs, repeat):
+    """
+    Return the quickest of repeat runs of fn over every one of inputs, in
+    seconds, along with how many calls there were in each run.
+    """
+
+    best = None
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for args in inputs:
+            fn(*args)
+        elapsed = time.perf_counter() - started
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, len(inputs)
+
+
+def run(repeat=DEFAULT_REPEAT, grids=DEFAULT_GRIDS):
+    # make sure we're not timing how long it takes to load the word list
+    get_dictionary()
+
+    images = {'png': [], 'jpeg': []}
+    for kind, data in screenshots():
+        images[kind].append(data)
+
+    boards = [
+        tuple(parse_image(BytesIO(data))) for data in images['png']
+    ] + list(random_grids(grids))
+
+    stages = {}
+
+    def add(name, fn, inputs):
+        total, calls = time_stage(fn, inputs, repeat)
+        stages[name] = {
+            'calls': calls,
+            'total': total,
+            'mean': total / calls if calls else 0,
+        }
+
+    for kind, data in sorted(images.items()):
+        add('parse_image[{}]'.format(kind), lambda d: parse_image(BytesIO(d)),
+            [(d,) for d in data])
+
+        loaded = [load_image(BytesIO(d))[0] for d in data]
+        add('top_of_grid[{}]'.format(kind), top_of_grid,
+            [(image,) for image in loaded])
+
+    add('closest_letter', closest_letter, [(path,) for path in LETTER_IMAGES])
+
+    for priority in PRIORITIES:
+        inputs = [
+            (Grid(letters, ownership, priority=priority),)
+            for letters, ownership in boards
+        ]
+
+        if priority == PRIORITIES[0]:
+            add('get_playable_words', lambda g: list(g.get_playable_words()),
+                inputs)
+            add('get_unique_playable_words',
+                lambda g: list(g.get_unique_playable_words()), inputs)
+
+        add('get_best_words[{}]'.format(priority), Grid.get_best_words,
+            inputs)
+
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'stages': stages,
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Return a description of every stage in results that's more than tolerance
+    slower than it was in baseline. Stages that weren't timed over the same
+    number of inputs both times can't be compared, and are skipped.
+    """
+
+    regressions = {}
+
+    for name, stage in results['stages'].items():
+        before = baseline.get('stages', {}).get(name)
+
+        if not before or before['calls'] != stage['calls'] or not (
+            before['total']
+        ):
+            continue
+
+        ratio = stage['total'] / before['total']
+
+        if ratio > 1 + tolerance:
+            regressions[name] = {
+                'before': before['total'],
+                'after': stage['total'],
+                'ratio': ratio,
+            }
+
+    return regressions
+
+
+def print_docs_and_exit():
+    print(__doc__.strip())
+    sys.exit(1)
+
+
+def main(args):
+    options = {}
+
+    for arg in args:
+        name, _, value = arg.partition('=')
+        if name not in (
+            '--repeat', '--grids', '--save', '--compare', '--tolerance'
+        ) or not value:
+            print_docs_and_exit()
+        options[name[2:]] = value
+
+    try:
+        repeat = int(options.get('repeat', DEFAULT_REPEAT))
+        grids = int(options.get('grids', DEFAULT_GRIDS))
+        tolerance = float(options.get('tolerance', DEFAULT_TOLERANCE))
+    except ValueError:
+        print_docs_and_exit()
+
+    results = run(repeat, grids)
+
+    if 'compare' in options:
+        with open(options['compare']) as f:
+            results['regressions'] = compare(results, json.load(f), tolerance)
+
+    if 'save' in options:
+        with open(options['save'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return 1 if results.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
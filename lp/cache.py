@@ -0,0 +1,309 @@
+"""
+Remembering work we've already done: what we read from screenshots we've seen
+before, and which words are best on grids we've already solved.
+
+Each cache keeps its entries in memory, least recently used first out, and
+optionally in a directory that several processes can share and that
+survives restarts.
+"""
+
+from collections import OrderedDict
+from hashlib import sha1
+from io import BytesIO
+import json
+import os
+import re
+import tempfile
+import threading
+
+from lp.game import GRID_SIZE, Grid, OPPONENT
+
+
+# how many entries each cache keeps in memory
+DEFAULT_SIZE = 256
+# where to keep each cache's entries on disk, if anywhere
+PARSE_CACHE_DIR = os.environ.get('LP_PARSE_CACHE_DIR') or None
+SOLVE_CACHE_DIR = os.environ.get('LP_SOLVE_CACHE_DIR') or None
+# bump these whenever parse_image starts reading screenshots differently or
+# words start being scored differently, so that we stop trusting anything we
+# worked out before
+PARSER_VERSION = 2
+SOLVER_VERSION = 3
+
+KEY_PATTERN = re.compile(r'[0-9a-f]{40}')
+
+# the tile indices of a grid after each of its rotations and reflections,
+# none of which change anything about how a game plays out
+SYMMETRIES = tuple(
+    tuple(
+        transform(row, column)
+        for row in range(GRID_SIZE) for column in range(GRID_SIZE)
+    ) for transform in (
+        lambda r, c: r * GRID_SIZE + c,
+        lambda r, c: c * GRID_SIZE + (GRID_SIZE - 1 - r),
+        lambda r, c: (GRID_SIZE - 1 - r) * GRID_SIZE + (GRID_SIZE - 1 - c),
+        lambda r, c: (GRID_SIZE - 1 - c) * GRID_SIZE + r,
+        lambda r, c: r * GRID_SIZE + (GRID_SIZE - 1 - c),
+        lambda r, c: (GRID_SIZE - 1 - r) * GRID_SIZE + c,
+        lambda r, c: c * GRID_SIZE + r,
+        lambda r, c: (GRID_SIZE - 1 - c) * GRID_SIZE + (GRID_SIZE - 1 - r),
+    )
+)
+
+
+def read_image(image):
+    """
+    Return the contents of image, which can be a path or a file-like object.
+    """
+
+    if hasattr(image, 'read'):
+        return image.read()
+
+    with open(image, 'rb') as f:
+        return f.read()
+
+
+def hash_key(data):
+    return sha1(data).hexdigest()
+
+
+class Cache(object):
+    """
+    A least-recently-used cache keyed on hex SHA-1 digests, with an optional
+    directory to fall back to on a miss. Subclasses say how their values are
+    written to and read from that directory.
+    """
+
+    name = None
+    version = 1
+
+    def __init__(self, size=DEFAULT_SIZE, directory=None):
+        self.size = size
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def encode(self, value):
+        raise NotImplementedError()
+
+    def decode(self, text):
+        """
+        Return the value written as text, or raise ValueError if it isn't one
+        we can use.
+        """
+
+        raise NotImplementedError()
+
+    def path_for(self, key):
+        return os.path.join(
+            self.directory, '{}-v{}'.format(self.name, self.version),
+            key[:2], key,
+        )
+
+    def get(self, key):
+        """
+        Return the value stored under key, or None if we don't remember it.
+        """
+
+        if not KEY_PATTERN.fullmatch(key):
+            return None
+
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                return value
+
+        if self.directory is None:
+            return None
+
+        try:
+            with open(self.path_for(key)) as f:
+                value = self.decode(f.read())
+        except (OSError, ValueError):
+            return None
+
+        self.remember(key, value)
+        return value
+
+    def set(self, key, value):
+        self.remember(key, value)
+
+        if self.directory is not None:
+            try:
+                self.write(key, value)
+            except OSError:
+                # another process will just have to work it out again
+                pass
+
+    def remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def write(self, key, value):
+        path = self.path_for(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.encode(value))
+            os.replace(temp_path, path)
+        except OSError:
+            os.remove(temp_path)
+            raise
+
+
+class ParseCache(Cache):
+    """
+    The letters and ownership parsed out of screenshots, keyed on a hash of
+    the image file's contents.
+    """
+
+    name = 'parse'
+    version = PARSER_VERSION
+
+    def __init__(self, size=DEFAULT_SIZE, directory=PARSE_CACHE_DIR):
+        super().__init__(size, directory)
+
+    def encode(self, parsed):
+        return '\n'.join(parsed)
+
+    def decode(self, text):
+        letters, ownership = text.split('\n')
+
+        if not len(letters) == len(ownership) == GRID_SIZE ** 2:
+            raise ValueError(text)
+
+        return letters, ownership
+
+    def parse(self, image):
+        """
+        Return the hash of image, along with the letters and ownership of the
+        grid in it, only actually parsing it if we've not seen it before.
+        """
+
+        from lp.image import parse_image
+
+        data = read_image(image)
+        key = hash_key(data)
+        parsed = self.get(key)
+
+        if parsed is None:
+            parsed = parse_image(BytesIO(data))
+            self.set(key, parsed)
+
+        return key, parsed
+
+
+def canonical_board(grid):
+    """
+    Return a string that's the same for every grid whose words would score
+    the same under grid's priority.
+    """
+
+    if grid.priority in Grid.PRIORITY_VALUES:
+        # these priorities only care how many of each letter are in each
+        # state, and not where they are
+        return ''.join(sorted(
+            t.letter + (
+                t.ownership.upper() if t.ownership == OPPONENT and
+                t.is_defended() else t.ownership
+            ) for t in grid.tiles
+        ))
+
+    ownership = ''.join(t.ownership for t in grid.tiles)
+
+    if grid.priority == Grid.LOOKAHEAD_PRIORITY:
+        # which copies of a letter a move takes depends on where they are, so
+        # only exactly the same grid is guaranteed to look ahead the same way
+        return grid.letters + ownership
+
+    return min(
+        ''.join(grid.letters[i] + ownership[i] for i in symmetry)
+        for symmetry in SYMMETRIES
+    )
+
+
+class SolveCache(Cache):
+    """
+    The best words to play on grids we've already solved, keyed on the
+    canonical form of each grid along with its priority and language.
+
+    Each entry remembers how many words were asked for, so that asking for
+    fewer can be answered from it but asking for more can't.
+    """
+
+    name = 'solve'
+    version = SOLVER_VERSION
+
+    def __init__(self, size=DEFAULT_SIZE, directory=SOLVE_CACHE_DIR):
+        super().__init__(size, directory)
+
+    def encode(self, entry):
+        return json.dumps(entry)
+
+    def decode(self, text):
+        count, words = json.loads(text)
+        return count, [(word, score) for word, score in words]
+
+    def key_for(self, grid):
+        return hash_key('{}:{}:{}'.format(
+            canonical_board(grid), grid.priority, grid.language,
+        ).encode('utf-8'))
+
+    def top_words(self, grid, count):
+        """
+        Return the same thing as grid.get_top_words(count), only working it
+        out if we've not already done so for an equivalent grid.
+        """
+
+        key = self.key_for(grid)
+        entry = self.get(key)
+
+        if entry is not None:
+            cached_count, words = entry
+
+            # if there were fewer words than we asked for last time, there
+            # aren't any more to find now
+            if count <= cached_count or len(words) < cached_count:
+                return words[:count]
+
+        words = grid.get_top_words(count)
+        self.set(key, (count, words))
+        return words
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(cls):
+    with _caches_lock:
+        if cls not in _caches:
+            _caches[cls] = cls()
+
+    return _caches[cls]
+
+
+def set_cache(cache):
+    """
+    Have get_cache() give us cache from now on, in place of whichever cache of
+    its type we'd otherwise have made.
+    """
+
+    with _caches_lock:
+        _caches[type(cache)] = cache
+
+
+def get_parse_cache():
+    return get_cache(ParseCache)
+
+
+def get_solve_cache():
+    return get_cache(SolveCache)
@@ -0,0 +1,449 @@
+"""
+Word lists, and the structures we use to find out which of their words can be
+played on a grid.
+
+Parsing a word list and building those structures takes a while, so the
+results are kept in a binary cache file that later runs can map straight into
+memory. A cache is keyed on the modification time and SHA-1 hash of the word
+list it was built from, and is rebuilt whenever that word list changes.
+"""
+
+from array import array
+from hashlib import sha1
+import mmap
+import os
+import struct
+import tempfile
+from string import ascii_lowercase
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+ALPHABET = ascii_lowercase
+DEFAULT_LANGUAGE = 'en'
+
+WORDS_DIR = os.path.join(os.path.dirname(__file__), 'words', 'Words')
+CACHE_DIR = os.environ.get('LP_CACHE_DIR') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache'
+    ), 'lp',
+)
+
+# bump the version byte whenever the layout below changes
+CACHE_MAGIC = b'lpwords\x01'
+# magic, source mtime, source size, source sha1, then the lengths of each of
+# the sections that follow: word bytes, words, groups, index entries, repeat
+# masks, and whether or not there's a letter matrix
+CACHE_HEADER = struct.Struct('=8sdQ20s6I')
+
+
+class NoSuchLanguageError(ValueError):
+    pass
+
+
+def letter_signature(letters):
+    """
+    Return a signature of how many times each letter of ALPHABET appears in
+    letters, or None if letters contains anything else.
+
+    The signature is a tuple of 26-bit masks, the nth of which has a bit set
+    for every letter that appears more than n times, so a word can be made
+    from a set of letters if each of its masks is a subset of the
+    corresponding mask of the letters.
+    """
+
+    signature = []
+
+    for letter in letters:
+        index = ord(letter) - ord('a')
+        if not 0 <= index < len(ALPHABET):
+            return None
+
+        bit = 1 << index
+        for n, mask in enumerate(signature):
+            if not mask & bit:
+                signature[n] = mask | bit
+                break
+        else:
+            signature.append(bit)
+
+    return tuple(signature)
+
+
+class WordIndex(object):
+    """
+    The words from a word list, grouped by the set of letters they use, so
+    that we only need to look closely at words whose letters a grid actually
+    has.
+
+    Everything is kept in flat arrays so that an index can be read straight
+    out of a cache file: group g contains the entries from bounds[g] to
+    bounds[g + 1], and entry e is the word at positions[e], whose signature is
+    masks[g] followed by repeats[repeat_bounds[e]:repeat_bounds[e + 1]].
+    """
+
+    def __init__(self, words, masks, bounds, positions, repeat_bounds,
+                 repeats):
+        self.words = words
+        self.masks = masks
+        self.bounds = bounds
+        self.positions = positions
+        self.repeat_bounds = repeat_bounds
+        self.repeats = repeats
+
+    @classmethod
+    def build(cls, words):
+        groups = {}
+
+        for position, word in enumerate(words):
+            signature = letter_signature(word)
+
+            if signature is None:
+                # this word contains something that isn't a letter we know
+                # about, so it can't be played on any grid we can index
+                continue
+
+            used = signature[0] if signature else 0
+            groups.setdefault(used, []).append((position, signature[1:]))
+
+        masks = array('I')
+        bounds = array('I', [0])
+        positions = array('I')
+        repeat_bounds = array('I', [0])
+        repeats = array('I')
+
+        for used, entries in groups.items():
+            masks.append(used)
+
+            for position, word_repeats in entries:
+                positions.append(position)
+                repeats.extend(word_repeats)
+                repeat_bounds.append(len(repeats))
+
+            bounds.append(len(positions))
+
+        return cls(words, masks, bounds, positions, repeat_bounds, repeats)
+
+    def get_playable_words(self, letters):
+        """
+        Return the words that can be made from letters, in word list order,
+        or None if letters can't be looked up in this index.
+        """
+
+        signature = letter_signature(letters)
+
+        if signature is None:
+            return None
+
+        available = signature[0] if signature else 0
+        repeats = signature[1:]
+        positions = []
+
+        for group, used in enumerate(self.masks):
+            if used & ~available:
+                continue
+
+            for entry in range(self.bounds[group], self.bounds[group + 1]):
+                start = self.repeat_bounds[entry]
+                end = self.repeat_bounds[entry + 1]
+
+                if end - start <= len(repeats) and not any(
+                    w & ~r for w, r in zip(self.repeats[start:end], repeats)
+                ):
+                    positions.append(self.positions[entry])
+
+        positions.sort()
+        return [self.words[p] for p in positions]
+
+
+class LetterMatrix(object):
+    """
+    The words from a word list as an N x 26 matrix of letter counts, so that
+    every word can be checked against a grid in one go with numpy.
+    """
+
+    def __init__(self, words, positions, counts):
+        self.words = words
+        self.positions = positions
+        self.counts = counts
+
+    @classmethod
+    def build(cls, words):
+        lengths = numpy.fromiter(map(len, words), dtype=numpy.intp,
+                                 count=len(words))
+        owners = numpy.repeat(numpy.arange(len(words)), lengths)
+        letters = numpy.frombuffer(
+            ''.join(words).encode('utf-32-le'), dtype='<u4',
+        ).astype(numpy.int64) - ord('a')
+
+        known = (letters >= 0) & (letters < len(ALPHABET))
+        counts = numpy.bincount(
+            owners[known] * len(ALPHABET) + letters[known],
+            minlength=len(words) * len(ALPHABET),
+        ).reshape(len(words), len(ALPHABET))
+
+        # as with WordIndex, words with letters we don't know about can't be
+        # played on any grid we can check, so we leave them out entirely
+        regular = numpy.ones(len(words), dtype=bool)
+        regular[owners[~known]] = False
+
+        return cls(
+            words,
+            numpy.flatnonzero(regular).astype(numpy.uint32),
+            counts[regular].astype(numpy.uint8),
+        )
+
+    def get_playable_words(self, letters):
+        """
+        Return the words that can be made from letters, in word list order,
+        or None if letters can't be looked up in this matrix.
+        """
+
+        grid_counts = numpy.zeros(len(ALPHABET), dtype=numpy.uint8)
+
+        for letter in letters:
+            index = ord(letter) - ord('a')
+            if not 0 <= index < len(ALPHABET):
+                return None
+            grid_counts[index] += 1
+
+        playable = (self.counts <= grid_counts).all(axis=1)
+        return [self.words[p] for p in self.positions[playable]]
+
+
+class Dictionary(object):
+    """
+    A word list, along with the index and letter matrix for looking words up
+    in it, each of which is built when first asked for if it wasn't in the
+    cache.
+    """
+
+    def __init__(self, words, index=None, matrix=None):
+        self.words = words
+        self._index = index
+        self._matrix = matrix
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = WordIndex.build(self.words)
+        return self._index
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = LetterMatrix.build(self.words)
+        return self._matrix
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load the word list at path from our cache if we can, and from the word
+        list itself (rebuilding the cache as we go) if we can't.
+        """
+
+        cache_path = cache_path_for(path)
+
+        try:
+            dictionary = read_cache(cache_path, path)
+        except (OSError, ValueError, struct.error):
+            dictionary = None
+
+        if dictionary is not None:
+            return dictionary
+
+        with open(path) as wf:
+            words = [
+                w.rstrip('\n').lower() for w in
+                wf.readlines()
+            ]
+
+        dictionary = cls(words)
+
+        try:
+            write_cache(cache_path, path, dictionary)
+        except OSError:
+            # we can live without a cache; we'll just be slower next time
+            pass
+
+        return dictionary
+
+
+def cache_path_for(path):
+    path = os.path.abspath(path)
+    return os.path.join(CACHE_DIR, '{}-{}.cache'.format(
+        os.path.splitext(os.path.basename(path))[0],
+        sha1(path.encode('utf-8')).hexdigest()[:12],
+    ))
+
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return sha1(f.read()).digest()
+
+
+def read_cache(cache_path, path):
+    """
+    Return a Dictionary mapped from the cache file at cache_path, or None if
+    that cache was built from anything other than the current contents of
+    the word list at path.
+    """
+
+    stat = os.stat(path)
+
+    with open(cache_path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (
+        magic, mtime, size, digest,
+        word_bytes, word_count, group_count, entry_count, repeat_count,
+        has_matrix,
+    ) = CACHE_HEADER.unpack_from(mapped)
+
+    expected_size = (
+        CACHE_HEADER.size + word_bytes + (-word_bytes % 4) +
+        4 * (2 * group_count + 2 * entry_count + repeat_count + 2) +
+        (entry_count * (4 + len(ALPHABET)) if has_matrix else 0)
+    )
+
+    if (
+        magic != CACHE_MAGIC or size != stat.st_size or
+        len(mapped) != expected_size
+    ):
+        return None
+
+    if mtime != stat.st_mtime:
+        # the word list has been touched, but that doesn't necessarily mean
+        # it's changed
+        if digest != hash_file(path):
+            return None
+
+        with open(cache_path, 'r+b') as f:
+            f.write(CACHE_HEADER.pack(
+                magic, stat.st_mtime, size, digest,
+                word_bytes, word_count, group_count, entry_count,
+                repeat_count, has_matrix,
+            ))
+
+    view = memoryview(mapped)
+    offset = CACHE_HEADER.size
+
+    def take(length, fmt='I'):
+        nonlocal offset
+        start, offset = offset, offset + length * struct.calcsize(fmt)
+        return view[start:offset].cast(fmt)
+
+    words = (
+        bytes(take(word_bytes, 'B')).decode('utf-8').split('\n')
+        if word_count else []
+    )
+    offset += -word_bytes % 4
+
+    index = WordIndex(
+        words,
+        masks=take(group_count),
+        bounds=take(group_count + 1),
+        positions=take(entry_count),
+        repeat_bounds=take(entry_count + 1),
+        repeats=take(repeat_count),
+    )
+
+    matrix = None
+
+    if has_matrix and numpy is not None:
+        positions = numpy.frombuffer(take(entry_count), dtype=numpy.uint32)
+        counts = numpy.frombuffer(
+            take(entry_count * len(ALPHABET), 'B'), dtype=numpy.uint8,
+        ).reshape(entry_count, len(ALPHABET))
+        matrix = LetterMatrix(words, positions, counts)
+
+    return Dictionary(words, index=index, matrix=matrix)
+
+
+def write_cache(cache_path, path, dictionary):
+    stat = os.stat(path)
+    index = dictionary.index
+    matrix = dictionary.matrix if numpy is not None else None
+
+    word_bytes = '\n'.join(dictionary.words).encode('utf-8')
+    sections = [
+        word_bytes, b'\0' * (-len(word_bytes) % 4),
+        index.masks, index.bounds, index.positions, index.repeat_bounds,
+        index.repeats,
+    ]
+
+    if matrix is not None:
+        sections.extend((
+            matrix.positions.astype(numpy.uint32).tobytes(),
+            matrix.counts.astype(numpy.uint8).tobytes(),
+        ))
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR)
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(CACHE_HEADER.pack(
+                CACHE_MAGIC, stat.st_mtime, stat.st_size, hash_file(path),
+                len(word_bytes), len(dictionary.words), len(index.masks),
+                len(index.positions), len(index.repeats),
+                matrix is not None,
+            ))
+            for section in sections:
+                f.write(section)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+
+_dictionaries = {}
+_dictionaries_lock = threading.Lock()
+
+
+def available_languages():
+    """
+    Return the codes of every language we have a word list for.
+    """
+
+    try:
+        filenames = os.listdir(WORDS_DIR)
+    except OSError:
+        return []
+
+    return sorted(
+        os.path.splitext(f)[0] for f in filenames
+        if f.endswith('.txt') and not f.startswith('.')
+    )
+
+
+def default_language():
+    return os.environ.get('LP_LANG', DEFAULT_LANGUAGE).lower()
+
+
+def get_dictionary(language=None):
+    """
+    Return the Dictionary for language (or for LP_LANG, if language is None),
+    loading it if this is the first time it's been asked for.
+    """
+
+    language = (language or default_language()).lower()
+    dictionary = _dictionaries.get(language)
+
+    if dictionary is not None:
+        return dictionary
+
+    if language not in available_languages():
+        raise NoSuchLanguageError(language)
+
+    with _dictionaries_lock:
+        if language not in _dictionaries:
+            _dictionaries[language] = Dictionary.load(
+                os.path.join(WORDS_DIR, '{}.txt'.format(language))
+            )
+
+    return _dictionaries[language]
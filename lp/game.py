@@ -1,28 +1,70 @@
+from collections import Counter
 from functools import partial
+import heapq
+from itertools import combinations
 import os
 
 from colors import black
 
-with open(os.path.join(
-    os.path.dirname(__file__), 'words', 'Words', '{}.txt'.format(
-        os.environ.get('LP_LANG', 'en').lower()
-    )
-)) as wf:
-    WORDS = [
-        w.rstrip('\n').lower() for w in
-        wf.readlines()
-    ]
+from lp import metrics
+from lp.dictionary import (
+    NoSuchLanguageError, available_languages, default_language,
+    get_dictionary,
+)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 OPPONENT = 'o'
 PLAYER = 'p'
 NOBODY = 'u'
 
 GRID_SIZE = 5
 
+# the indices of the tiles adjacent to each tile in a grid
+NEIGHBOURS = tuple(
+    tuple(
+        i for i in range(GRID_SIZE ** 2) if
+        (index - i == 1 and index % GRID_SIZE) or
+        (index - i == -1 and i % GRID_SIZE) or
+        index - i in (GRID_SIZE, -GRID_SIZE)
+    ) for index in range(GRID_SIZE ** 2)
+)
+
+# bitmasks covering every tile, and every tile in the first and last columns,
+# of a grid in which tile i is represented by bit i
+FULL_MASK = (1 << GRID_SIZE ** 2) - 1
+FIRST_COLUMN = sum(1 << (row * GRID_SIZE) for row in range(GRID_SIZE))
+LAST_COLUMN = FIRST_COLUMN << (GRID_SIZE - 1)
+
+
+def adjacent_to(mask):
+    """
+    Return a mask of every tile adjacent to at least one tile in mask.
+    """
+
+    return (
+        ((mask << 1) & ~FIRST_COLUMN) |
+        ((mask >> 1) & ~LAST_COLUMN) |
+        (mask << GRID_SIZE) |
+        (mask >> GRID_SIZE)
+    ) & FULL_MASK
+
+
+def count_tiles(mask):
+    return bin(mask).count('1')
+
 
 class NoSuchPriorityError(ValueError):
     pass
 
 
+class NoSuchEngineError(ValueError):
+    pass
+
+
 class Grid(object):
     """
     A representation of the state of a grid in a given game.
@@ -30,6 +72,15 @@ class Grid(object):
 
     NET_SCORE_PRIORITY = 'ns'
     AVOID_SPREADING_PRIORITY = 'plg'
+    BEST_TILES_PRIORITY = 'bt'
+    LOOKAHEAD_PRIORITY = 'la'
+
+    # what taking a tile from our opponent and claiming an unclaimed tile are
+    # worth under each priority
+    PRIORITY_VALUES = {
+        NET_SCORE_PRIORITY: (2, 1),
+        AVOID_SPREADING_PRIORITY: (1, -1),
+    }
 
     PRIORITIES = {
         NET_SCORE_PRIORITY: (
@@ -41,11 +92,49 @@ class Grid(object):
             "situations when you're trying not to give away an easy word "
             "that'll let your opponent win."
         ),
+        BEST_TILES_PRIORITY: (
+            "Work out which tiles each word should take, favouring ones that "
+            "break your opponent's defences and shore up your own, and score "
+            "words on the tiles and defences you'd end up with."
+        ),
+        LOOKAHEAD_PRIORITY: (
+            "Look ahead to your opponent's best reply to each word, and score "
+            "words on where that would leave you."
+        ),
     }
 
-    def __init__(self, letters, ownership, priority=NET_SCORE_PRIORITY):
+    INDEX_ENGINE = 'index'
+    NUMPY_ENGINE = 'numpy'
+
+    ENGINES = {
+        INDEX_ENGINE: (
+            "Look up words in an index grouped by the letters they use."
+        ),
+        NUMPY_ENGINE: (
+            "Check every word at once against a matrix of letter counts. "
+            "Requires numpy."
+        ),
+    }
+
+    def __init__(self, letters, ownership, priority=NET_SCORE_PRIORITY,
+                 engine=None, language=None):
         letters = letters.lower()
 
+        if engine is None:
+            engine = os.environ.get('LP_ENGINE', Grid.INDEX_ENGINE).lower()
+
+        if engine not in Grid.ENGINES or (
+            engine == Grid.NUMPY_ENGINE and numpy is None
+        ):
+            raise NoSuchEngineError(engine)
+
+        language = (language or default_language()).lower()
+
+        if language not in available_languages():
+            raise NoSuchLanguageError(language)
+
+        self._summary = None
+
         self.tiles = [
             Tile(l, s, self, i)
             for i, (l, s) in enumerate(zip(letters, ownership))
@@ -55,6 +144,8 @@ class Grid(object):
         self.letters = letters
 
         self.priority = priority
+        self.engine = engine
+        self.language = language
 
     def __str__(self):
         return '{}\n{}'.format(
@@ -64,19 +155,32 @@ class Grid(object):
             )
         )
 
+    @classmethod
+    def from_board(cls, board, **kw):
+        return cls(board.letters, board.ownership(), **kw)
+
     @classmethod
     def from_image(cls, image, **kw):
-        from lp.image import parse_image
-        return cls(*parse_image(image), **kw)
+        from lp.cache import get_parse_cache
+        key, parsed = get_parse_cache().parse(image)
+        return cls(*parsed, **kw)
+
+    def get_summary(self):
+        if self._summary is None:
+            self._summary = GridSummary(self)
+        return self._summary
+
+    def get_board(self):
+        return self.get_summary().board
 
-    def _score_for(self, player):
-        return len([t for t in self.tiles if t.ownership == player])
+    def ownership_changed(self):
+        self._summary = None
 
     def player_score(self):
-        return self._score_for(PLAYER)
+        return self.get_summary().scores[PLAYER]
 
     def opponent_score(self):
-        return self._score_for(OPPONENT)
+        return self.get_summary().scores[OPPONENT]
 
     def word_is_playable(self, word):
         available_letters = list(self.letters)
@@ -89,9 +193,26 @@ class Grid(object):
         return True
 
     def get_playable_words(self):
-        for word in WORDS:
-            if self.word_is_playable(word):
-                yield word
+        dictionary = get_dictionary(self.language)
+
+        if self.engine == Grid.NUMPY_ENGINE:
+            index = dictionary.matrix
+        else:
+            index = dictionary.index
+
+        with metrics.stage('playable_words'):
+            playable = index.get_playable_words(self.letters)
+
+        metrics.count('candidate_words', len(dictionary.words))
+
+        if playable is not None:
+            metrics.count('playable_words', len(playable))
+        else:
+            playable = (
+                w for w in dictionary.words if self.word_is_playable(w)
+            )
+
+        yield from playable
 
     def get_unique_playable_words(self):
         """
@@ -99,77 +220,369 @@ class Grid(object):
         would leave room for the opponent to play a longer version.
         """
 
-        playable = sorted(
-            self.get_playable_words(),
-            key=lambda w: len(w),
-            reverse=True,
-        )
+        with metrics.stage('unique_words'):
+            playable = sorted(
+                self.get_playable_words(),
+                key=lambda w: len(w),
+                reverse=True,
+            )
 
-        blocked = set()
+            # in alphabetical order, any word that begins with another word
+            # comes after it, with nothing but other words that begin with it
+            # in between, so we only need to compare each word with the next
+            # one
+            alphabetical = sorted(set(playable))
+            blocked = {
+                word for word, following in zip(alphabetical, alphabetical[1:])
+                if word and following.startswith(word)
+            }
+
+        if metrics.current_trace() is not None:
+            metrics.count(
+                'unique_words', sum(w not in blocked for w in playable),
+            )
 
         for word in playable:
             if word not in blocked:
                 yield word
 
-            for i in range(1, len(word)):
-                blocked.add(word[:i])
+    def get_best_tiles(self, word):
+        """
+        Return a mask of the tiles it'd be best to play word with and what
+        playing them would be worth, counting the change in both score and
+        defended tiles for each player.
+
+        Only tiles that would change hands are included in the mask, since it
+        doesn't matter which copies of any other letters are used. Claiming a
+        tile can never make things worse for us, so we always claim as many
+        as we can and only have to pick which copies of each letter to claim.
+        Claiming every candidate is an upper bound on what any subset of them
+        is worth, which lets us skip most subsets without looking at them.
+        """
+
+        summary = self.get_summary()
+        board = summary.board
+        before = board_value(board)
+
+        choices = []
+
+        for letter in set(word):
+            candidates = summary.claimable_tiles.get(letter, ())
+            wanted = min(word.count(letter), len(candidates))
+            if wanted:
+                choices.append((candidates, wanted))
+
+        # the tiles still up for grabs from each choice onwards
+        remaining = [0] * (len(choices) + 1)
+        for i in reversed(range(len(choices))):
+            remaining[i] = remaining[i + 1] | sum(choices[i][0])
+
+        def value_of(tiles):
+            after = board.play(tiles)
+            value = board_value(after) - before
+
+            if not after.unclaimed() and (
+                after.player_score() > after.opponent_score()
+            ):
+                value += float('inf')
+
+            return value
+
+        best = [0, None]
+
+        def search(i, tiles):
+            if best[1] is not None and (
+                value_of(tiles | remaining[i]) <= best[1]
+            ):
+                return
+
+            if i == len(choices):
+                best[:] = tiles, value_of(tiles)
+                return
+
+            candidates, wanted = choices[i]
+            for chosen in combinations(candidates, wanted):
+                search(i + 1, tiles | sum(chosen))
+
+        search(0, 0)
+        return tuple(best)
+
+    def get_search(self):
+        from lp.search import Search
+        return Search(self.get_board(), self.get_unique_playable_words())
 
     def get_value_of_word(self, word):
-        undefended_opponent_letters = [
-            t.letter for t in self.tiles
-            if t.ownership == OPPONENT and not t.is_defended()
-        ]
-        unclaimed_letters = [
-            t.letter for t in self.tiles
-            if t.ownership == NOBODY
-        ]
+        if self.priority == Grid.BEST_TILES_PRIORITY:
+            return self.get_best_tiles(word)[1]
+
+        if self.priority == Grid.LOOKAHEAD_PRIORITY:
+            return self.get_search().rank([word])[0][1]
+
+        summary = self.get_summary()
+        values = Grid.PRIORITY_VALUES.get(self.priority)
+        unclaimed = summary.unclaimed_count
 
         score = 0
 
-        for letter in word:
-            if letter in undefended_opponent_letters:
-                if self.priority == Grid.NET_SCORE_PRIORITY:
-                    score += 2
-                elif self.priority == Grid.AVOID_SPREADING_PRIORITY:
-                    score += 1
-                else:
-                    raise NoSuchPriorityError()
-
-                undefended_opponent_letters.remove(letter)
-            elif letter in unclaimed_letters:
-                if self.priority == Grid.NET_SCORE_PRIORITY:
-                    score += 1
-                elif self.priority == Grid.AVOID_SPREADING_PRIORITY:
-                    score -= 1
-                else:
-                    raise NoSuchPriorityError()
-
-                unclaimed_letters.remove(letter)
-
-        if len(unclaimed_letters) == 0 and score > (
-            self.opponent_score() - self.player_score()
+        for letter in set(word):
+            wanted = word.count(letter)
+            taken = min(wanted, summary.undefended_opponent_letters[letter])
+            claimed = min(wanted - taken, summary.unclaimed_letters[letter])
+
+            if not (taken or claimed):
+                continue
+
+            if values is None:
+                raise NoSuchPriorityError()
+
+            take_value, claim_value = values
+            score += (taken * take_value) + (claimed * claim_value)
+            unclaimed -= claimed
+
+        if unclaimed == 0 and score > (
+            summary.scores[OPPONENT] - summary.scores[PLAYER]
         ):
             score += float('inf')
 
         return score
 
     def get_best_words(self):
-        return sorted((
-            (w, self.get_value_of_word(w))
-            for w in self.get_unique_playable_words()
-        ), key=lambda ws: (ws[1], -len(ws[0])), reverse=True)
+        with metrics.stage('rank'):
+            if self.priority == Grid.LOOKAHEAD_PRIORITY:
+                best_words = self.get_search().rank()
+            else:
+                best_words = sorted((
+                    (w, self.get_value_of_word(w))
+                    for w in self.get_unique_playable_words()
+                ), key=lambda ws: (ws[1], -len(ws[0])), reverse=True)
+
+        metrics.count('scored_words', len(best_words))
+        return best_words
+
+    def get_value_bound(self, length):
+        """
+        Return the most a word of a given length could possibly be worth, or
+        None if we can't tell without scoring it.
+        """
+
+        values = Grid.PRIORITY_VALUES.get(self.priority)
+
+        if values is None:
+            return None
+
+        summary = self.get_summary()
+
+        # a word long enough to claim every unclaimed tile might win, even if
+        # that means taking fewer of our opponent's tiles than it could
+        if length >= summary.unclaimed_count:
+            return float('inf')
+
+        take_value, claim_value = values
+        taken = min(length, sum(summary.undefended_opponent_letters.values()))
+        claimed = min(length - taken, summary.unclaimed_count)
+
+        return (taken * take_value) + (claimed * max(claim_value, 0))
+
+    def get_top_words(self, count):
+        """
+        Return the same thing as get_best_words()[:count], but only keep the
+        best count words as we go, and skip scoring any word that couldn't
+        possibly make it into them.
+        """
+
+        if self.priority == Grid.LOOKAHEAD_PRIORITY:
+            return self.get_best_words()[:count]
+
+        if count < 1:
+            return []
+
+        scored = 0
+
+        with metrics.stage('rank'):
+            # the worst of the best words we've seen so far is at the top of
+            # this heap. where scores and lengths match, the word we saw first
+            # wins, so that we agree with the stable sort in get_best_words()
+            best = []
+
+            for seen, word in enumerate(self.get_unique_playable_words()):
+                if len(best) == count:
+                    bound = self.get_value_bound(len(word))
+
+                    if bound is not None:
+                        if bound < best[0][0]:
+                            # words only get shorter from here, so none of the
+                            # rest can beat what we have either
+                            break
+
+                        if (bound, -len(word), -seen) <= best[0][:3]:
+                            continue
+
+                entry = (self.get_value_of_word(word), -len(word), -seen, word)
+                scored += 1
+
+                if len(best) < count:
+                    heapq.heappush(best, entry)
+                elif entry > best[0]:
+                    heapq.heapreplace(best, entry)
+
+        metrics.count('scored_words', scored)
+
+        return [
+            (word, score) for score, _, _, word in sorted(best, reverse=True)
+        ]
 
     def rows(self):
         for i in range(GRID_SIZE):
             yield self.tiles[i * GRID_SIZE:(i + 1) * GRID_SIZE]
 
 
+class Board(object):
+    """
+    A compact, immutable representation of the ownership of a grid, with the
+    tiles owned by each player as bitmasks in which tile i is bit i. Cheap
+    enough to make lots of, so good for trying out moves.
+    """
+
+    __slots__ = ('letters', 'player', 'opponent')
+
+    def __init__(self, letters, player, opponent):
+        self.letters = letters
+        self.player = player
+        self.opponent = opponent
+
+    def __eq__(self, other):
+        return isinstance(other, Board) and (
+            (self.letters, self.player, self.opponent) ==
+            (other.letters, other.player, other.opponent)
+        )
+
+    def __hash__(self):
+        return hash((self.letters, self.player, self.opponent))
+
+    @classmethod
+    def from_ownership(cls, letters, ownership):
+        player = opponent = 0
+
+        for i, owner in enumerate(ownership):
+            if owner == PLAYER:
+                player |= 1 << i
+            elif owner == OPPONENT:
+                opponent |= 1 << i
+
+        return cls(letters, player, opponent)
+
+    def ownership(self):
+        return ''.join(
+            PLAYER if self.player >> i & 1 else
+            OPPONENT if self.opponent >> i & 1 else
+            NOBODY
+            for i in range(len(self.letters))
+        )
+
+    def unclaimed(self):
+        return ((1 << len(self.letters)) - 1) & ~(self.player | self.opponent)
+
+    def defended(self):
+        """
+        Return a mask of every tile surrounded by tiles of its own colour.
+        """
+
+        return (
+            (self.player & ~adjacent_to(FULL_MASK & ~self.player)) |
+            (self.opponent & ~adjacent_to(FULL_MASK & ~self.opponent))
+        )
+
+    def player_score(self):
+        return count_tiles(self.player)
+
+    def opponent_score(self):
+        return count_tiles(self.opponent)
+
+    def play(self, tiles):
+        """
+        Return the board as it would be after the player played a word using
+        the tiles in mask tiles. Defended opponent tiles stay where they are.
+        """
+
+        claimed = tiles & ~(self.opponent & self.defended())
+        return Board(
+            self.letters, self.player | claimed, self.opponent & ~claimed,
+        )
+
+    def swapped(self):
+        """
+        Return this board from our opponent's point of view.
+        """
+
+        return Board(self.letters, self.opponent, self.player)
+
+
+def board_value(board):
+    """
+    How good board is for the player: their lead in score plus their lead in
+    defended tiles.
+    """
+
+    defended = board.defended()
+    return (
+        board.player_score() - board.opponent_score() +
+        count_tiles(board.player & defended) -
+        count_tiles(board.opponent & defended)
+    )
+
+
+class GridSummary(object):
+    """
+    Facts about the ownership of the tiles in a grid that we'd otherwise be
+    working out again for every word we score. Grids throw theirs away
+    whenever the ownership of a tile changes.
+    """
+
+    def __init__(self, grid):
+        self.board = Board.from_ownership(
+            ''.join(t.letter for t in grid.tiles),
+            ''.join(t.ownership for t in grid.tiles),
+        )
+        defended = self.board.defended()
+        self.defended = tuple(
+            bool(defended >> t.index & 1) for t in grid.tiles
+        )
+        self.scores = Counter(t.ownership for t in grid.tiles)
+        self.undefended_opponent_letters = Counter(
+            t.letter for t in grid.tiles
+            if t.ownership == OPPONENT and not self.defended[t.index]
+        )
+        self.unclaimed_letters = Counter(
+            t.letter for t in grid.tiles if t.ownership == NOBODY
+        )
+        self.unclaimed_count = sum(self.unclaimed_letters.values())
+
+        # the tiles of each letter that would change hands if played
+        self.claimable_tiles = {}
+        for t in grid.tiles:
+            if t.ownership == NOBODY or (
+                t.ownership == OPPONENT and not self.defended[t.index]
+            ):
+                self.claimable_tiles.setdefault(t.letter, []).append(
+                    1 << t.index
+                )
+
+
 class Tile(object):
     def __init__(self, letter, ownership, grid, index):
         self.letter = letter
-        self.ownership = ownership
         self.grid = grid
         self.index = index
+        self.ownership = ownership
+
+    @property
+    def ownership(self):
+        return self._ownership
+
+    @ownership.setter
+    def ownership(self, ownership):
+        self._ownership = ownership
+        self.grid.ownership_changed()
 
     def __str__(self):
         d = 'negative'
@@ -186,15 +599,7 @@ class Tile(object):
         )
 
     def get_neighbours(self):
-        return (
-            self.grid.tiles[i] for i in range(GRID_SIZE ** 2) if
-            (self.index - i == 1 and self.index % GRID_SIZE) or
-            (self.index - i == -1 and i % GRID_SIZE) or
-            self.index - i in (GRID_SIZE, -GRID_SIZE)
-        )
+        return (self.grid.tiles[i] for i in NEIGHBOURS[self.index])
 
     def is_defended(self):
-        return self.ownership != NOBODY and all((
-            t.ownership == self.ownership
-            for t in self.get_neighbours()
-        ))
+        return self.grid.get_summary().defended[self.index]
@@ -1,10 +1,10 @@
+from hashlib import sha1
 import os
-import shutil
+import struct
 try:
     from string import ascii_uppercase as uppercase
 except ImportError:
     from string import uppercase
-import tempfile
 
 import cv2
 import numpy
@@ -12,6 +12,7 @@ from PIL import Image, ImageOps, ImageFilter, ImageEnhance
 from PIL.Image import NONE
 
 from lp.game import GRID_SIZE, NOBODY, OPPONENT, PLAYER
+from lp import metrics
 
 
 class LPImageException(Exception):
@@ -68,9 +69,19 @@ THEMES = (
 )
 
 
+# the width we scale screenshots down to before we read them, which still
+# leaves every tile far bigger than the comparison matrices we boil letters
+# down to
+WORKING_WIDTH = 640
+
 # the fractions of the edges of tiles we'll cut off to get rid of wiggle
 # artifacts
 TILE_MARGIN = 6
+# the fraction of the size of a tile that each side of the patches we vote on
+# its colour from (one in each corner of what's left after TILE_MARGIN) is
+OWNERSHIP_PATCH = 12
+# how many of the top bits of each channel we look colours up by
+COLOUR_TABLE_BITS = 5
 # the difference in colour that, if seen, makes us think a row isn't homogenous
 HOMOGENOUS_ERROR_MARGIN = 5
 # the difference we expect to see between game background and unclaimed tile
@@ -86,8 +97,15 @@ COMPARISON_MATCH_THRESHOLD = 0.3
 COMPARISON_RELATIVE_CONFIDENCE_THRESHOLD = 1.5
 
 
-def invariant_for(image_path):
-    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+def invariant_for(image):
+    """
+    Return the comparison matrix for image, which is either the path to an
+    image file or a greyscale image as an array.
+    """
+
+    if isinstance(image, str):
+        image = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+
     _, threshold = cv2.threshold(image, 127, 255, cv2.THRESH_BINARY_INV)
     mask = threshold > 0
     cropped = threshold[numpy.ix_(mask.any(1), mask.any(0))]
@@ -103,11 +121,109 @@ def invariant_for(image_path):
     return resized
 
 
-LETTER_INVARIANTS = {
-    letter: invariant_for(os.path.join(
-        os.path.dirname(__file__), 'images', '{}.png'.format(letter)
-    )) for letter in uppercase
-}
+def pack_invariants(invariants):
+    """
+    Pack a stack of comparison matrices into a bit per pixel, so that we can
+    compare lots of them at once.
+    """
+
+    invariants = numpy.asarray(invariants) > 0
+    return numpy.packbits(
+        invariants.reshape(len(invariants), -1), axis=1,
+    )
+
+
+IMAGES_DIR = os.path.join(os.path.dirname(__file__), 'images')
+LETTER_IMAGES = [
+    os.path.join(IMAGES_DIR, '{}.png'.format(letter)) for letter in uppercase
+]
+# the packed comparison matrices for every letter, built from LETTER_IMAGES by
+# make_images.py (or whenever we find it's out of date)
+LETTER_INVARIANTS_PATH = os.path.join(IMAGES_DIR, 'letters.bin')
+# bump the version byte whenever the layout below or invariant_for() changes
+LETTER_INVARIANTS_MAGIC = b'lpltrs\x00\x01'
+# magic, comparison matrix size, then the sha1 of the letter images the
+# matrices were built from
+LETTER_INVARIANTS_HEADER = struct.Struct('=8sI20s')
+
+
+def hash_letter_images():
+    digest = sha1()
+    for path in LETTER_IMAGES:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.digest()
+
+
+def build_letter_invariants():
+    return pack_invariants([invariant_for(path) for path in LETTER_IMAGES])
+
+
+def write_letter_invariants(packed, path=LETTER_INVARIANTS_PATH):
+    with open(path, 'wb') as f:
+        f.write(LETTER_INVARIANTS_HEADER.pack(
+            LETTER_INVARIANTS_MAGIC, COMPARISON_MATRIX_SIZE,
+            hash_letter_images(),
+        ))
+        f.write(packed.tobytes())
+
+
+def read_letter_invariants(path=LETTER_INVARIANTS_PATH):
+    """
+    Return the packed comparison matrices stored at path, or None if they're
+    missing or weren't built from the letter images we have now.
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, size, digest = LETTER_INVARIANTS_HEADER.unpack_from(data)
+    except (OSError, struct.error):
+        return None
+
+    row_bytes = -(-COMPARISON_MATRIX_SIZE ** 2 // 8)
+
+    if (
+        magic != LETTER_INVARIANTS_MAGIC or
+        size != COMPARISON_MATRIX_SIZE or
+        len(data) != (
+            LETTER_INVARIANTS_HEADER.size + len(LETTER_IMAGES) * row_bytes
+        ) or
+        digest != hash_letter_images()
+    ):
+        return None
+
+    return numpy.frombuffer(
+        data, dtype=numpy.uint8, offset=LETTER_INVARIANTS_HEADER.size,
+    ).reshape(len(LETTER_IMAGES), row_bytes)
+
+
+def load_letter_invariants():
+    packed = read_letter_invariants()
+
+    if packed is None:
+        packed = build_letter_invariants()
+
+        try:
+            write_letter_invariants(packed)
+        except OSError:
+            # we can live without it; we'll just have to build it again
+            pass
+
+    return packed
+
+
+PACKED_LETTER_INVARIANTS = load_letter_invariants()
+# the comparison matrix for each letter, in alphabetical order, as a single
+# (26, COMPARISON_MATRIX_SIZE, COMPARISON_MATRIX_SIZE) boolean array
+LETTER_INVARIANTS = numpy.unpackbits(
+    PACKED_LETTER_INVARIANTS, axis=1, count=COMPARISON_MATRIX_SIZE ** 2,
+).reshape(
+    len(LETTER_IMAGES), COMPARISON_MATRIX_SIZE, COMPARISON_MATRIX_SIZE,
+).astype(bool)
+# how many bits are set in each possible byte
+POPCOUNTS = numpy.array([bin(i).count('1') for i in range(256)],
+                        dtype=numpy.uint16)
 
 
 def colour_diff(a, b):
@@ -121,51 +237,153 @@ def closest_colour(colour, colours):
     return min(colours, key=lambda c: colour_diff(c, colour))
 
 
-def compare_invariants(a, b):
-    diff = 0
+# who each of the colours in a theme means owns a tile
+THEME_OWNERS = (OPPONENT, OPPONENT, NOBODY, PLAYER, PLAYER)
+OWNERS = (OPPONENT, NOBODY, PLAYER)
+# the unclaimed colours of THEMES, each only once
+BACKGROUNDS = tuple(dict.fromkeys(t[2] for t in THEMES))
+
+
+def build_owner_tables(bits=COLOUR_TABLE_BITS):
+    """
+    Return a lookup table for each of BACKGROUNDS, indexed by the top bits of
+    each channel of a colour (see colour_table_index()), of which of OWNERS
+    the closest_colour() to it in any theme with that background means owns a
+    tile.
+
+    Each entry is worked out for the colour in the middle of the range of
+    colours it covers, so we can look colours up without needing to compare
+    them to anything. That's only good enough because the colours in a theme
+    are nowhere near each other; backgrounds can be, so we don't do this for
+    them.
+    """
+
+    # the colour in the middle of each range, for one channel
+    levels = (
+        numpy.arange(1 << bits) << (8 - bits)
+    ) + ((1 << (8 - bits)) >> 1)
+    tables = []
+
+    for background in BACKGROUNDS:
+        colours = {}
+        for theme in (t for t in THEMES if t[2] == background):
+            for colour, owner in zip(theme, THEME_OWNERS):
+                colours[colour] = OWNERS.index(owner)
+
+        # colour_diff() is a sum over channels, so we can work out each
+        # channel's part of it separately and then add them all up
+        r, g, b = numpy.abs(
+            levels[numpy.newaxis, :, numpy.newaxis] -
+            numpy.array(list(colours)).T[:, numpy.newaxis, :]
+        )
+        diffs = (
+            r[:, numpy.newaxis, numpy.newaxis] +
+            g[numpy.newaxis, :, numpy.newaxis] +
+            b[numpy.newaxis, numpy.newaxis, :]
+        ).reshape(-1, len(colours))
+
+        # the closest of colours to each cell, preferring whichever comes
+        # first in a tie, like closest_colour() does
+        owners = numpy.array(list(colours.values()), dtype=numpy.uint8)
+        tables.append(owners[diffs.argmin(axis=1)])
+
+    return numpy.stack(tables)
+
+
+OWNER_TABLES = build_owner_tables()
 
-    for row_a, row_b in zip(a, b):
-        for px_a, px_b in zip(row_a, row_b):
-            if px_a != px_b:
-                diff += 1
 
-    return diff / (COMPARISON_MATRIX_SIZE ** 2)
+def colour_table_index(colours, bits=COLOUR_TABLE_BITS):
+    """
+    Return the index into OWNER_TABLES of each of an array of colours.
+    """
+
+    top = numpy.asarray(colours, dtype=numpy.uint8) >> (8 - bits)
+    return (
+        (top[..., 0].astype(numpy.intp) << (2 * bits)) |
+        (top[..., 1].astype(numpy.intp) << bits) |
+        top[..., 2]
+    )
 
 
-def closest_letter(image_path):
-    invariant = invariant_for(image_path)
-    differences = {  # letters and how similar our letter is to each of them
-        letter: compare_invariants(LETTER_INVARIANTS[letter], invariant)
-        for letter in LETTER_INVARIANTS.keys()
-    }
+def tile_ownership(pixels, top_padding, background):
+    """
+    Return who owns each tile of the grid that starts top_padding pixels down
+    pixels (an image as an RGB array) in a theme with the background at that
+    index of BACKGROUNDS, going by a majority vote of the colours in a patch
+    in each corner of the tile.
+    """
 
-    best_letter = min(
-        differences.keys(),
-        key=lambda l: differences[l],
+    base = pixels.shape[1] / GRID_SIZE
+    patch = numpy.arange(max(int(base / OWNERSHIP_PATCH), 1))
+    edges = numpy.arange(GRID_SIZE)[:, numpy.newaxis] * base
+    # the offsets of the columns (or rows) of pixels in each tile's patches
+    offsets = numpy.round(numpy.concatenate((
+        edges + base / TILE_MARGIN + patch,
+        edges + base - base / TILE_MARGIN - len(patch) + patch,
+    ), axis=1)).astype(int)
+
+    samples = pixels[
+        (offsets + top_padding)[:, numpy.newaxis, :, numpy.newaxis],
+        offsets[numpy.newaxis, :, numpy.newaxis, :],
+    ]
+    owners = OWNER_TABLES[background][colour_table_index(samples)]
+
+    # count the votes for every tile at once, by giving each tile its own
+    # range of len(OWNERS) bins
+    votes = numpy.bincount((
+        owners.reshape(GRID_SIZE ** 2, -1) +
+        numpy.arange(0, GRID_SIZE ** 2 * len(OWNERS), len(OWNERS))[
+            :, numpy.newaxis
+        ]
+    ).ravel(), minlength=GRID_SIZE ** 2 * len(OWNERS)).reshape(
+        GRID_SIZE ** 2, len(OWNERS),
     )
 
-    if differences[best_letter] > COMPARISON_MATCH_THRESHOLD:
-        # we're not 100% certain, let's make sure we're at least pretty
-        # confident (worth noting that a 100% match is very very unlikely, this
-        # is mostly just here to catch divide-by-zero errors)
+    return [OWNERS[i] for i in votes.argmax(axis=1)]
 
-        next_best_letter = min(
-            (k for k in differences.keys() if k != best_letter),
-            key=lambda l: differences[l],
-        )
 
-        # the relative difference in confidence between our best pick and the
-        # next best pick. should be higher than COMPARISON_MATCH_THRESHOLD,
-        # otherwise we aren't sure enough to present it as truth
+def closest_letters(invariants):
+    """
+    Return the letter that each of a sequence of comparison matrices shows,
+    comparing every one of them to every letter at once.
+    """
 
-        relative_confidence = (
-            differences[next_best_letter] / differences[best_letter]
-        )
+    if not len(invariants):
+        return []
+
+    packed = pack_invariants(invariants)
 
-        if relative_confidence < COMPARISON_RELATIVE_CONFIDENCE_THRESHOLD:
-            raise LPImageException(TOO_LITTLE_CONFIDENCE_ERROR)
+    # letters and how similar each of our letters is to each of them
+    differences = POPCOUNTS[
+        packed[:, numpy.newaxis, :] ^ PACKED_LETTER_INVARIANTS[numpy.newaxis]
+    ].sum(axis=2) / (COMPARISON_MATRIX_SIZE ** 2)
 
-    return best_letter
+    ranked = numpy.sort(differences, axis=1)
+    best, next_best = ranked[:, 0], ranked[:, 1]
+
+    for i in range(len(differences)):
+        if best[i] > COMPARISON_MATCH_THRESHOLD:
+            # we're not 100% certain, let's make sure we're at least pretty
+            # confident (worth noting that a 100% match is very very
+            # unlikely, this is mostly just here to catch divide-by-zero
+            # errors)
+            #
+            # the relative difference in confidence between our best pick and
+            # the next best pick. should be higher than
+            # COMPARISON_MATCH_THRESHOLD, otherwise we aren't sure enough to
+            # present it as truth
+
+            relative_confidence = next_best[i] / best[i]
+
+            if relative_confidence < COMPARISON_RELATIVE_CONFIDENCE_THRESHOLD:
+                raise LPImageException(TOO_LITTLE_CONFIDENCE_ERROR)
+
+    return [uppercase[i] for i in differences.argmin(axis=1)]
+
+
+def closest_letter(image):
+    return closest_letters([invariant_for(image)])[0]
 
 
 def grid_centres(width):
@@ -176,7 +394,7 @@ def grid_centres(width):
         )
 
 
-def top_of_grid(image):
+def top_of_grid(image, pixels=None):
     """
     find a range of points in the y axis where every point that aligns with the
     centre of a square in a row is within colour_diff() HOMOGENOUS_ERROR_MARGIN
@@ -185,6 +403,7 @@ def top_of_grid(image):
     row with the different colours, or the point image.width pixels from the
     bottom of the image
 
+    pixels, if we've already got them, should be image as an array.
     """
 
     # search_range is the vertical distance of pixels to consider checking
@@ -208,44 +427,78 @@ def top_of_grid(image):
     if not (stop_at > start_at):
         raise LPImageException(NOT_NARROW_ENOUGH_ERROR)
 
-    for ypx in range(start_at, stop_at):
-        top_row_colours = set()
-        for xpx in grid_centres(image.width):
-            top_row_colours.add(image.getpixel((xpx, ypx)))
-
-        # abandon if the row isn't homogenous
-        if len(top_row_colours) > 1:
-            max_diff = 0
-            for colour_a, colour_b in (
-                (a, b) for a in top_row_colours for b in top_row_colours
-            ):
-                diff = colour_diff(colour_a, colour_b)
-                if diff > max_diff:
-                    max_diff = diff
-
-            if max_diff > HOMOGENOUS_ERROR_MARGIN:
-                continue
-
-        # okay, we have a top row that's homogenous, so now we check below:
-        bottom_row_colours = set()
-        for xpx in grid_centres(image.width):
-            bottom_row_colours.add(image.getpixel((xpx, ypx + search_range)))
-
-        if all((
-            colour_diff(a, b) > COLOUR_DIFF_THRESHOLD
-            for a in top_row_colours for b in bottom_row_colours
-        )):
-            return ypx + search_range
+    metrics.count('rows_scanned', stop_at - start_at)
+
+    # the colours at the centre of each column of tiles, for every row of the
+    # image we might want to look at
+    if pixels is None:
+        pixels = numpy.asarray(image)
+    pixels = pixels.astype(numpy.int16)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, numpy.newaxis]
+    samples = pixels[:, list(grid_centres(image.width))]
+
+    top_rows = samples[start_at:stop_at]
+    bottom_rows = samples[start_at + search_range:stop_at + search_range]
+
+    def colour_diffs(a, b):
+        # the colour_diff() of every pair of colours from a and b, row by row
+        return numpy.abs(
+            a[:, :, numpy.newaxis, :] - b[:, numpy.newaxis, :, :]
+        ).sum(axis=3)
+
+    # a top row has to be homogenous, and then everything below it needs to
+    # be different to everything in it
+    homogenous = (
+        colour_diffs(top_rows, top_rows).max(axis=(1, 2)) <=
+        HOMOGENOUS_ERROR_MARGIN
+    )
+    contrasting = (
+        colour_diffs(top_rows, bottom_rows).min(axis=(1, 2)) >
+        COLOUR_DIFF_THRESHOLD
+    )
+
+    matches = numpy.flatnonzero(homogenous & contrasting)
+
+    if len(matches):
+        return start_at + int(matches[0]) + search_range
 
     raise LPImageException(GRID_NOT_FOUND_ERROR)
 
 
-def parse_image(image):
-    letters = []
-    ownership = []
+def load_image(image):
+    """
+    Return the screenshot in image (a path or a file) as an RGB image no wider
+    than WORKING_WIDTH, along with the colour of its top left corner before
+    it was resized (a jpeg may already have been decoded at a smaller size by
+    then, but that's still well within the background).
+    """
+
+    image = Image.open(image)
+    working_size = (
+        WORKING_WIDTH, round(image.height * WORKING_WIDTH / image.width),
+    )
+
+    if image.width > WORKING_WIDTH:
+        # jpegs can be decoded at a fraction of their full size for a
+        # fraction of the cost, which gets us most of the way there
+        image.draft('RGB', working_size)
+
+    image = image.convert('RGB')
+    corner = image.getpixel((3, 3))
 
-    dirpath = tempfile.mkdtemp()
-    image = Image.open(image).convert('RGB')
+    if image.width > WORKING_WIDTH:
+        # everything else happens at the same resolution, however big the
+        # screenshot was
+        image = image.resize(working_size, Image.BOX)
+
+    return image, corner
+
+
+def parse_image(image):
+    with metrics.stage('decode'):
+        image, corner = load_image(image)
+        pixels = numpy.asarray(image)
 
     # we can look at the top left pixel of the image to find out what our
     # unclaimed colour is, and thereby produce a shortlist of the themes that
@@ -253,62 +506,63 @@ def parse_image(image):
     #
     # it must be noted that this is not a perfect approach; the pink theme, for
     # example, has slightly different colours for unclaimed and the background
-    unclaimed_colours = [c[2] for c in THEMES]
-    unclaimed_colour = closest_colour(image.getpixel((3, 3)),
-                                      unclaimed_colours)
-    colours = {
-        c: (OPPONENT, OPPONENT, NOBODY, PLAYER, PLAYER)[i]
-        for theme in (
-            t for t in THEMES
-            if t[2] == unclaimed_colour
-        )
-        for i, c in enumerate(theme)
-    }
+    background = BACKGROUNDS.index(closest_colour(corner, BACKGROUNDS))
 
     width, height = image.size
     base = width / GRID_SIZE
-    top_padding = top_of_grid(image)
 
-    crops = []
-
-    for x, y in ((x, y) for y in range(GRID_SIZE) for x in range(GRID_SIZE)):
-        coords = (
-            (x * base) + base/TILE_MARGIN,
-            (y * base) + top_padding + base/TILE_MARGIN,
-            ((x + 1) * base) - base/TILE_MARGIN,
-            ((y + 1) * base) + top_padding - base/TILE_MARGIN,
-        )
-        crop = image.crop(coords)
-        crop_path = os.path.join(dirpath, '{}_{}.png'.format(x, y))
-
-        ownership.append(
-            colours[closest_colour(crop.getpixel((0, 0)), colours.keys())]
-        )
+    with metrics.stage('top_of_grid'):
+        top_padding = top_of_grid(image, pixels)
 
-        crop = crop.convert('L')
-        crop = ImageOps.autocontrast(crop, 0)
-
-        # remove weird jpg artifacts:
-        gaussian = ImageFilter.GaussianBlur(radius=base/100)
-        crop = crop.filter(gaussian)
-        contraster = ImageEnhance.Contrast(crop)
-        crop = contraster.enhance(10)
-        crops.append(crop)
-
-        # invert, if necessary
-        bg = crop.getpixel((0, 0))
-        if bg == 0:
-            crop = ImageOps.invert(crop)
-        elif bg == 255:
-            pass
-        else:
-            raise LPImageException(UNCLEAN_TILE_ERROR)
-
-        crop = crop.convert('1', dither=NONE)
-        crop.save(crop_path)
-
-        letters.append(closest_letter(crop_path))
-
-    shutil.rmtree(dirpath)
+    crops = []
+    invariants = []
+    failure = None
+
+    with metrics.stage('tiles'):
+        ownership = tile_ownership(pixels, top_padding, background)
+
+        for x, y in (
+            (x, y) for y in range(GRID_SIZE) for x in range(GRID_SIZE)
+        ):
+            coords = (
+                (x * base) + base/TILE_MARGIN,
+                (y * base) + top_padding + base/TILE_MARGIN,
+                ((x + 1) * base) - base/TILE_MARGIN,
+                ((y + 1) * base) + top_padding - base/TILE_MARGIN,
+            )
+            crop = image.crop(coords)
+            crop = crop.convert('L')
+            crop = ImageOps.autocontrast(crop, 0)
+
+            # remove weird jpg artifacts:
+            gaussian = ImageFilter.GaussianBlur(radius=base/100)
+            crop = crop.filter(gaussian)
+            contraster = ImageEnhance.Contrast(crop)
+            crop = contraster.enhance(10)
+            crops.append(crop)
+
+            try:
+                # invert, if necessary
+                bg = crop.getpixel((0, 0))
+                if bg == 0:
+                    crop = ImageOps.invert(crop)
+                elif bg == 255:
+                    pass
+                else:
+                    raise LPImageException(UNCLEAN_TILE_ERROR)
+
+                crop = crop.convert('1', dither=NONE).convert('L')
+                invariants.append(invariant_for(numpy.asarray(crop)))
+            except Exception as e:
+                # we match every tile at once, but if any of the tiles before
+                # this one can't be read, that's the problem we should report
+                failure = e
+                break
+
+    with metrics.stage('match'):
+        letters = closest_letters(invariants)
+
+    if failure is not None:
+        raise failure
 
     return (''.join(letters), ''.join(ownership))
@@ -1,6 +1,11 @@
 """
 Create a bunch of images to compare tiles we're looking at against. This should
 really only need to be run once, ever, and the results will be bundled with lp.
+
+Once the images are made, the comparison matrices lp actually uses are built
+from them and bundled alongside them as letters.bin. lp will rebuild that
+itself if it finds it doesn't match the images, but it's quicker if it doesn't
+have to.
 """
 
 import os
@@ -30,5 +35,9 @@ def make_image_for(letter):
 
 if __name__ == '__main__':
     from string import ascii_uppercase
+    from lp.image import build_letter_invariants, write_letter_invariants
+
     for letter in ascii_uppercase:
         make_image_for(letter)
+
+    write_letter_invariants(build_letter_invariants())
@@ -0,0 +1,220 @@
+"""
+Solving grids in the background, so that reading a big screenshot doesn't tie
+up whichever web worker it was uploaded to.
+
+Jobs are handed to a local pool of threads (or processes, with
+LP_JOB_EXECUTOR=process) and can then be checked on by their ID until they're
+done. Only so many jobs can be waiting at once; past that, new ones are turned
+away until the pool catches up.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from io import BytesIO
+import logging
+import os
+import secrets
+import threading
+import time
+
+from lp import metrics
+from lp.batch import prepare_worker
+from lp.cache import get_parse_cache, get_solve_cache
+from lp.game import Grid
+from lp.image import LPImageException
+
+
+# how many workers to solve jobs with; the queue is disabled if this is 0
+JOB_WORKERS = int(os.environ.get('LP_JOB_WORKERS') or 0)
+JOB_EXECUTOR = os.environ.get('LP_JOB_EXECUTOR', 'thread')
+# how many jobs can be waiting or running at once
+MAX_PENDING_JOBS = int(os.environ.get('LP_JOB_QUEUE_SIZE') or 64)
+# how long, in seconds, to keep the results of finished jobs around for
+JOB_TTL = 300
+# the longest, in seconds, we'll keep someone waiting for a job to finish
+MAX_WAIT = 30
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# what to tell people when a job fails for a reason that isn't about what's
+# in their screenshot
+JOB_ERROR = (
+    "Something went wrong while we were reading your screenshot. Please make "
+    "sure it's a PNG or JPEG and try again."
+)
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def solve(letters, ownership, image, priority, language, count):
+    """
+    Return the grid described by letters and ownership (or, if letters is
+    None, the grid in the screenshot whose contents are image) and the best
+    count words to play on it.
+    """
+
+    with metrics.trace('job'):
+        image_hash = None
+
+        if letters is None:
+            image_hash, (letters, ownership) = get_parse_cache().parse(
+                BytesIO(image)
+            )
+
+        grid = Grid(letters, ownership, priority=priority, language=language)
+
+        return {
+            'letters': grid.letters,
+            'ownership': ''.join(t.ownership for t in grid.tiles),
+            'priority': grid.priority,
+            'language': grid.language,
+            'image_hash': image_hash,
+            'words': get_solve_cache().top_words(grid, count),
+        }
+
+
+class Job(object):
+    def __init__(self, job_id, future):
+        self.id = job_id
+        self.future = future
+        self.finished_at = None
+
+    def status(self):
+        if not self.future.done():
+            return PENDING
+
+        if self.future.exception() is None:
+            return DONE
+
+        return FAILED
+
+    def result(self):
+        return self.future.result()
+
+    def error(self):
+        error = self.future.exception()
+
+        if isinstance(error, LPImageException):
+            return str(error)
+
+        # anything else isn't something we should be showing people; it got
+        # logged when the job finished
+        return JOB_ERROR
+
+
+class JobQueue(object):
+    def __init__(self, workers, executor=JOB_EXECUTOR,
+                 max_pending=MAX_PENDING_JOBS, ttl=JOB_TTL):
+        if executor == 'process':
+            self.pool = ProcessPoolExecutor(
+                workers, initializer=prepare_worker,
+            )
+        else:
+            self.pool = ThreadPoolExecutor(workers)
+
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.jobs = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def prune(self):
+        expired = time.monotonic() - self.ttl
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and job.finished_at < expired:
+                del self.jobs[job_id]
+
+    def submit(self, fn, *args):
+        """
+        Return a new Job running fn(*args), or raise QueueFullError if there
+        are already too many jobs waiting.
+        """
+
+        with self.lock:
+            self.prune()
+
+            if self.pending >= self.max_pending:
+                raise QueueFullError()
+
+            self.pending += 1
+
+        try:
+            future = self.pool.submit(fn, *args)
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+            raise
+
+        job = Job(secrets.token_hex(16), future)
+
+        with self.lock:
+            self.jobs[job.id] = job
+
+        future.add_done_callback(lambda f: self.finished(job))
+        return job
+
+    def finished(self, job):
+        with self.lock:
+            self.pending -= 1
+            job.finished_at = time.monotonic()
+
+        error = job.future.exception()
+
+        if error is not None and not isinstance(error, LPImageException):
+            logger.error('job %s failed', job.id, exc_info=error)
+
+    def get(self, job_id, timeout=0):
+        """
+        Return the job with job_id, or None if there's no such job, after
+        waiting up to timeout seconds for it to finish.
+        """
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+
+        if job is not None and timeout > 0:
+            wait([job.future], timeout=min(timeout, MAX_WAIT))
+
+        return job
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """
+    Return our JobQueue, or None if we've been configured not to have one.
+    """
+
+    global _job_queue
+
+    if not JOB_WORKERS:
+        return None
+
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(JOB_WORKERS)
+
+    return _job_queue
+
+
+def shutdown_job_queue():
+    """
+    Wait for any jobs we have running to finish, and stop taking new ones.
+    """
+
+    global _job_queue
+
+    with _job_queue_lock:
+        if _job_queue is not None:
+            _job_queue.shutdown()
+            _job_queue = None
@@ -0,0 +1,201 @@
+"""
+Keeping track of where the time goes when we read a screenshot or solve a
+grid.
+
+Everything here does nothing unless LP_METRICS is set (or enable() has been
+called), and even then only while a trace is running. Code we want to measure
+wraps the interesting parts of itself in stage() and reports anything worth
+counting with count(); whoever's doing the measuring wraps the whole lot in
+trace(), and gets back a Trace describing it.
+
+Stage times are exclusive, so time spent in a stage that's running inside
+another stage only counts towards the inner one.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+
+ENABLED = bool(os.environ.get('LP_METRICS'))
+
+logger = logging.getLogger(__name__)
+
+
+class Trace(object):
+    """
+    How long each stage of something took, in seconds, and what we counted
+    while it was happening.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = Counter()
+        self.counters = Counter()
+        self.started = time.perf_counter()
+        self.total = None
+        self.details = {}
+        self.running = []
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'details': self.details,
+            'total': self.total,
+            'stages': dict(self.stages),
+            'counters': dict(self.counters),
+        }
+
+
+class Stage(object):
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.inner = 0
+
+    def __enter__(self):
+        self.trace.running.append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        self.trace.running.pop()
+        self.trace.stages[self.name] += elapsed - self.inner
+
+        if self.trace.running:
+            self.trace.running[-1].inner += elapsed
+
+
+class NullContext(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_CONTEXT = NullContext()
+
+
+class Totals(object):
+    """
+    Everything we've traced since we started, added up.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.traces = Counter()
+            self.time = Counter()
+            self.stages = Counter()
+            self.counters = Counter()
+
+    def add(self, trace):
+        with self.lock:
+            self.traces[trace.name] += 1
+            self.time[trace.name] += trace.total
+            self.stages.update(trace.stages)
+            self.counters.update(trace.counters)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'traces': dict(self.traces),
+                'time': dict(self.time),
+                'stages': dict(self.stages),
+                'counters': dict(self.counters),
+            }
+
+
+totals = Totals()
+_local = threading.local()
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def current_trace():
+    return getattr(_local, 'trace', None) if ENABLED else None
+
+
+def start_trace(name):
+    """
+    Start tracing everything that happens on this thread, and return the
+    Trace we'll be recording it in (or None if we're not tracing, or are
+    already tracing something this is part of).
+    """
+
+    if not ENABLED or current_trace() is not None:
+        return None
+
+    trace = _local.trace = Trace(name)
+    return trace
+
+
+def finish_trace(trace):
+    if trace is None:
+        return
+
+    _local.trace = None
+    trace.finish()
+    totals.add(trace)
+    logger.info(json.dumps(trace.as_dict(), sort_keys=True))
+
+
+@contextmanager
+def trace(name):
+    """
+    Trace everything that happens inside this context manager, which gives
+    us the Trace from start_trace().
+    """
+
+    trace = start_trace(name)
+
+    try:
+        yield trace
+    finally:
+        finish_trace(trace)
+
+
+def stage(name):
+    """
+    Return a context manager that times everything inside it as the named
+    stage of whatever we're tracing.
+    """
+
+    trace = current_trace()
+
+    if trace is None:
+        return NULL_CONTEXT
+
+    return Stage(trace, name)
+
+
+def count(name, amount=1):
+    trace = current_trace()
+
+    if trace is not None:
+        trace.counters[name] += amount
+
+
+def configure_logging():
+    """
+    Make sure the line we log for each trace ends up somewhere.
+    """
+
+    if ENABLED and not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.INFO)
@@ -0,0 +1,301 @@
+"""
+Looking further ahead than one move, by trying each of our moves against our
+opponent's best replies.
+
+A search runs in passes of increasing depth, each of which works out a value
+for every word we could play, and keeps the values from the deepest pass that
+finished within its time budget. The first pass only looks at our own move and
+always finishes. The second, which also looks at our opponent's best reply,
+scores every reply at once with numpy and should finish well within the
+default budget for any real grid. Deeper passes use alpha-beta pruning and a
+transposition table, and will run out of time on busy grids.
+"""
+
+import time
+
+import numpy
+
+from lp.game import count_tiles
+
+
+# how many moves ahead to look, counting our move as the first
+DEFAULT_DEPTH = 2
+# how long, in seconds, we're willing to spend searching for one grid
+DEFAULT_TIME_BUDGET = 1.0
+# how many positions to remember before we start forgetting them all again
+TRANSPOSITION_TABLE_SIZE = 1 << 18
+
+WIN = float('inf')
+
+EXACT, LOWER_BOUND, UPPER_BOUND = range(3)
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class Search(object):
+    """
+    A search for the best words to play on a board, from the point of view of
+    the player, choosing from words.
+    """
+
+    def __init__(self, board, words, depth=DEFAULT_DEPTH,
+                 time_budget=DEFAULT_TIME_BUDGET):
+        self.board = board
+        self.words = list(words)
+        self.depth = depth
+        self.time_budget = time_budget
+        self.table = {}
+        self.deadline = None
+
+        letters = sorted(set(board.letters))
+        self.columns = {letter: i for i, letter in enumerate(letters)}
+
+        # which tiles each letter is on, and how many of each letter each
+        # word needs
+        self.tile_letters = numpy.array(
+            [self.columns[letter] for letter in board.letters],
+            dtype=numpy.intp,
+        )
+        self.letter_tiles = [
+            [1 << i for i, l in enumerate(board.letters) if l == letter]
+            for letter in letters
+        ]
+        self.counts = self.count_letters(self.words)
+        self.replies = self.strongest(self.counts)
+
+    def count_letters(self, words):
+        counts = numpy.zeros((len(words), len(self.columns)),
+                             dtype=numpy.int16)
+        for i, word in enumerate(words):
+            for letter in word:
+                counts[i, self.columns[letter]] += 1
+        return counts
+
+    def strongest(self, counts):
+        """
+        Return the rows of counts that no other row has at least as many of
+        every letter as. Playing more letters never scores less, so unless
+        one of these ends the game without winning it (where a move that
+        leaves a tile unclaimed can be better), the best immediate move is
+        always one of these.
+        """
+
+        counts = numpy.unique(counts, axis=0)
+        counts = counts[numpy.argsort(-counts.sum(axis=1), kind='stable')]
+        strongest = numpy.empty_like(counts)
+        found = 0
+
+        for row in counts:
+            if not (strongest[:found] >= row).all(axis=1).any():
+                strongest[found] = row
+                found += 1
+
+        return strongest[:found]
+
+    def net(self, board):
+        return board.player_score() - board.opponent_score()
+
+    def terminal_value(self, board):
+        net = self.net(board)
+        return WIN if net > 0 else -WIN if net < 0 else 0
+
+    def is_over(self, board):
+        return not board.unclaimed()
+
+    def letter_counts(self, mask):
+        return numpy.bincount(
+            self.tile_letters[[
+                i for i in range(len(self.tile_letters)) if mask >> i & 1
+            ]],
+            minlength=len(self.letter_tiles),
+        )
+
+    def move_values(self, board, counts=None):
+        """
+        Return the net score the player on board would have after playing each
+        of our words (or each of the words counted in counts), taking
+        undefended opponent tiles before unclaimed ones.
+        """
+
+        return self.move_outcomes(board, counts)[0]
+
+    def move_outcomes(self, board, counts=None):
+        """
+        Return the same thing as move_values(), along with whether each move
+        would end the game.
+        """
+
+        if counts is None:
+            counts = self.counts
+
+        unclaimed = board.unclaimed()
+        takeable = self.letter_counts(board.opponent & ~board.defended())
+        claimable = self.letter_counts(unclaimed)
+
+        taken = numpy.minimum(counts, takeable)
+        claimed = numpy.minimum(counts - taken, claimable)
+
+        values = (
+            self.net(board) + 2 * taken.sum(axis=1) + claimed.sum(axis=1)
+        ).astype(float)
+
+        # words that would claim the last unclaimed tiles end the game
+        over = claimed.sum(axis=1) == count_tiles(unclaimed)
+        values[over & (values > 0)] = WIN
+        values[over & (values < 0)] = -WIN
+        values[over & (values == 0)] = 0
+
+        return values, over
+
+    def move_for(self, board, counts):
+        """
+        Return a mask of the tiles the player on board would take by playing
+        a word with the letter counts in counts, taking undefended opponent
+        tiles before unclaimed ones.
+        """
+
+        takeable = board.opponent & ~board.defended()
+        unclaimed = board.unclaimed()
+        tiles = 0
+
+        for letter, wanted in enumerate(counts):
+            if not wanted:
+                continue
+
+            candidates = (
+                [t for t in self.letter_tiles[letter] if t & takeable] +
+                [t for t in self.letter_tiles[letter] if t & unclaimed]
+            )
+            tiles |= sum(candidates[:wanted])
+
+        return tiles
+
+    def negamax(self, board, depth, alpha, beta):
+        """
+        Return the value to the player on board of the best line of play
+        depth moves deep, or a bound on it if it's outside alpha and beta.
+        """
+
+        if len(self.table) >= TRANSPOSITION_TABLE_SIZE:
+            self.table.clear()
+
+        if self.is_over(board):
+            return self.terminal_value(board)
+
+        if depth == 0:
+            return self.net(board)
+
+        key = (board.player, board.opponent, depth)
+        entry = self.table.get(key)
+
+        if depth == 1:
+            if entry is None:
+                values, over = self.move_outcomes(board, self.replies)
+
+                if (over & (values != WIN)).any():
+                    # one of the strongest replies ends the game without
+                    # winning it, so a weaker one that keeps it going might
+                    # be better; we'll have to look at all of them
+                    values = self.move_values(board)
+
+                entry = self.table[key] = (
+                    float(values.max()) if len(values) else self.net(board),
+                    EXACT,
+                )
+            return entry[0]
+
+        if entry is not None:
+            value, flag = entry
+            if flag == EXACT:
+                return value
+            elif flag == LOWER_BOUND:
+                alpha = max(alpha, value)
+            elif flag == UPPER_BOUND:
+                beta = min(beta, value)
+
+            if alpha >= beta:
+                return value
+
+        original_alpha = alpha
+        best = self.net(board) if not self.words else -WIN
+        seen = set()
+
+        # try the moves that look best right now first, so that we prune as
+        # much as possible of everything else
+        values = self.move_values(board)
+
+        for word in numpy.argsort(-values, kind='stable'):
+            if time.monotonic() > self.deadline:
+                raise SearchTimeout()
+
+            tiles = self.move_for(board, self.counts[word])
+            if tiles in seen:
+                continue
+            seen.add(tiles)
+
+            value = -self.negamax(
+                board.play(tiles).swapped(), depth - 1, -beta, -alpha,
+            )
+
+            best = max(best, value)
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        self.table[key] = (best, (
+            UPPER_BOUND if best <= original_alpha else
+            LOWER_BOUND if best >= beta else
+            EXACT
+        ))
+
+        return best
+
+    def run_pass(self, counts, depth):
+        """
+        Return the value of playing each of the words counted in counts,
+        searching depth moves deep.
+        """
+
+        if depth == 1:
+            return [float(v) for v in self.move_values(self.board, counts)]
+
+        values = []
+
+        for word_counts in counts:
+            if time.monotonic() > self.deadline:
+                raise SearchTimeout()
+
+            after = self.board.play(self.move_for(self.board, word_counts))
+            values.append(-self.negamax(
+                after.swapped(), depth - 1, -WIN, WIN,
+            ))
+
+        return values
+
+    def rank(self, words=None):
+        """
+        Return our words (or just the ones in words), along with what playing
+        each of them would do to our net score by the end of the deepest
+        search we had time to finish, best first.
+        """
+
+        if words is None:
+            words = self.words
+
+        self.deadline = time.monotonic() + self.time_budget
+        counts = self.count_letters(words)
+        net = self.net(self.board)
+        values = self.run_pass(counts, 1)
+
+        for depth in range(2, self.depth + 1):
+            try:
+                values = self.run_pass(counts, depth)
+            except SearchTimeout:
+                break
+
+        return sorted((
+            (w, v if v in (WIN, -WIN) else int(v) - net)
+            for w, v in zip(words, values)
+        ), key=lambda ws: (ws[1], -len(ws[0])), reverse=True)
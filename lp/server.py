@@ -1,10 +1,52 @@
 import os
-from flask import Flask, request, render_template, session, abort
+import sys
+from flask import (
+    Flask, request, render_template, session, abort, jsonify, redirect,
+    url_for, g,
+)
 
-from lp.game import Grid
+from lp import metrics
+from lp.batch import format_score
+from lp.cache import get_parse_cache
+from lp.dictionary import available_languages, default_language
+from lp.game import GRID_SIZE, NOBODY, OPPONENT, PLAYER, Grid
 from lp.image import LPImageException
+from lp.jobs import (
+    DONE, FAILED, PENDING, QueueFullError, get_job_queue, solve,
+)
 
 TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'page.html')
+# how many words to suggest
+WORD_COUNT = 50
+
+FORGOTTEN_IMAGE_ERROR = (
+    "We've forgotten the screenshot you uploaded. Please upload it again."
+)
+
+UNREADABLE_IMAGE_ERROR = (
+    "We couldn't open the image you uploaded. Please make sure it's a PNG or "
+    "JPEG screenshot."
+)
+
+BUSY_ERROR = (
+    "We're reading too many screenshots right now. Please try again in a "
+    "moment."
+)
+# how long, in seconds, to suggest waiting before trying again when we're busy
+RETRY_AFTER = 5
+
+# whether to answer requests for metrics at all; behind a reverse proxy on the
+# same machine every request looks local, so this has to be asked for
+METRICS_ENDPOINT = bool(os.environ.get('LP_METRICS_ENDPOINT'))
+# where we'll answer requests for metrics from
+LOCAL_ADDRESSES = {'127.0.0.1', '::1'}
+
+# views that don't use sessions, and so don't need protecting from CSRF
+CSRF_EXEMPT_ENDPOINTS = {'api_words', 'api_jobs'}
+
+
+class BadRequestError(ValueError):
+    pass
 
 
 app = Flask(__name__)
@@ -16,12 +58,35 @@ app.config.update({
 
 @app.before_request
 def csrf_protect():
-    if request.method == "POST":
+    if (
+        request.method == "POST" and
+        request.endpoint not in CSRF_EXEMPT_ENDPOINTS
+    ):
         token = session.pop('_csrf_token', None)
         if not token or token != request.form.get('_csrf_token'):
             abort(403)
 
 
+@app.before_request
+def start_trace():
+    g.trace = metrics.start_trace('request')
+
+
+@app.after_request
+def describe_trace(response):
+    if g.get('trace') is not None:
+        g.trace.details.update({
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+        })
+    return response
+
+
+@app.teardown_request
+def finish_trace(error):
+    metrics.finish_trace(g.pop('trace', None))
+
+
 def generate_csrf_token():
     if '_csrf_token' not in session:
         session['_csrf_token'] = repr(os.urandom(128))
@@ -31,49 +96,323 @@ def generate_csrf_token():
 app.jinja_env.globals['csrf_token'] = generate_csrf_token
 
 
+def grid_context(result):
+    """
+    Return what page.html needs to show a grid that lp.jobs.solve() has
+    returned the result of solving.
+    """
+
+    grid = Grid(
+        result['letters'], result['ownership'],
+        priority=result['priority'], language=result['language'],
+    )
+
+    if result['image_hash'] is not None:
+        # if this was solved in another process, we need to remember the
+        # screenshot ourselves so that it can be solved again with another
+        # priority
+        get_parse_cache().set(
+            result['image_hash'], (result['letters'], result['ownership']),
+        )
+
+    return {
+        'grid': grid,
+        'image_hash': result['image_hash'],
+        'priority': grid.priority,
+        'language': grid.language,
+        'words': result['words'],
+        'inf': float('inf'),
+    }
+
+
 def words():
     image = request.files.get('image')
+    image_hash = request.form.get('image_hash')
     priority = request.form.get('priority')
+    language = request.form.get('language')
 
     if priority not in Grid.PRIORITIES.keys():
         priority = Grid.NET_SCORE_PRIORITY
 
-    if not image:
+    if language not in available_languages():
+        language = default_language()
+
+    cache = get_parse_cache()
+    queue = get_job_queue()
+
+    if image and queue is not None:
+        try:
+            job = queue.submit(
+                solve, None, None, image.read(), priority, language,
+                WORD_COUNT,
+            )
+        except QueueFullError:
+            return {'error': BUSY_ERROR}
+
+        return {'job': job}
+    elif image:
+        try:
+            image_hash, parsed = cache.parse(image)
+        except LPImageException as e:
+            return {'error': str(e)}
+        except OSError:
+            return {'error': UNREADABLE_IMAGE_ERROR}
+    elif image_hash:
+        # the same screenshot again, most likely with a different priority
+        parsed = cache.get(image_hash)
+        if parsed is None:
+            return {'error': FORGOTTEN_IMAGE_ERROR}
+    else:
         return {}
 
-    try:
-        grid = Grid.from_image(image, priority=priority)
-    except LPImageException as e:
-        return {'error': str(e)}
+    result = solve(*parsed, None, priority, language, WORD_COUNT)
+    result['image_hash'] = image_hash
+    return grid_context(result)
 
+
+def page_context():
     return {
-        'grid': grid,
-        'inf': float('inf'),
+        'grid': None,
+        'priorities': Grid.PRIORITIES,
+        'priority': request.form.get('priority', Grid.NET_SCORE_PRIORITY),
+        'languages': available_languages(),
+        'language': request.form.get('language', default_language()),
     }
 
 
 @app.route('/', methods=['POST', 'GET'])
 def result():
-    context = {
-        'grid': None,
-        'priorities': Grid.PRIORITIES,
-    }
+    context = page_context()
 
     if request.method == 'POST':
         context.update(words())
 
+    if context.get('job') is not None:
+        return redirect(url_for('job_result', job_id=context['job'].id))
+
+    if context.get('error') == BUSY_ERROR:
+        return render_template('page.html', **context), 503, {
+            'Retry-After': str(RETRY_AFTER),
+        }
+
+    return render_template('page.html', **context)
+
+
+@app.route('/jobs/<job_id>')
+def job_result(job_id):
+    queue = get_job_queue()
+    job = queue.get(job_id) if queue is not None else None
+
+    if job is None:
+        abort(404)
+
+    context = page_context()
+    status = job.status()
+
+    if status == PENDING:
+        context['pending'] = True
+    elif status == FAILED:
+        context['error'] = job.error()
+    else:
+        context.update(grid_context(job.result()))
+
     return render_template('page.html', **context)
 
 
-def serve(address):
+def api_request(params):
+    """
+    Return the arguments to lp.jobs.solve() described by params, reading the
+    uploaded screenshot only if we weren't told the grid's letters directly.
+    """
+
+    letters = params.get('letters')
+    ownership = params.get('ownership')
+    priority = params.get('priority', Grid.NET_SCORE_PRIORITY)
+    language = params.get('language') or default_language()
+    image = request.files.get('image')
+
+    for name in ('priority', 'language', 'limit'):
+        if not isinstance(params.get(name, ''), (str, int, float)):
+            raise BadRequestError('{} must be a string or a number'.format(
+                name,
+            ))
+
+    if priority not in Grid.PRIORITIES:
+        raise BadRequestError('unknown priority {!r}'.format(priority))
+
+    if str(language).lower() not in available_languages():
+        raise BadRequestError('unknown language {!r}'.format(language))
+
+    try:
+        limit = int(params.get('limit', WORD_COUNT))
+    except (TypeError, ValueError):
+        limit = -1
+
+    if limit < 0:
+        raise BadRequestError('limit must be a whole number')
+
+    if letters is not None:
+        letters = str(letters).lower()
+        ownership = str(ownership or NOBODY * len(letters)).lower()
+
+        if not (
+            len(letters) == GRID_SIZE ** 2 and letters.isalpha() and
+            len(ownership) == len(letters) and
+            set(ownership) <= {NOBODY, OPPONENT, PLAYER}
+        ):
+            raise BadRequestError(
+                'letters and ownership must each be {} characters long, and '
+                'ownership may only contain {!r}, {!r} and {!r}'.format(
+                    GRID_SIZE ** 2, PLAYER, OPPONENT, NOBODY,
+                )
+            )
+
+        return letters, ownership, None, priority, language, limit
+    elif image:
+        return None, None, image.read(), priority, language, limit
+
+    raise BadRequestError('provide either letters or an image')
+
+
+def api_params():
+    """
+    Return the parameters of an API request, which can be sent as a JSON
+    object or as a form; screenshots can only be sent as a form.
+    """
+
+    params = request.get_json(silent=True)
+    return params if isinstance(params, dict) else request.form
+
+
+def api_result(result):
+    return dict(result, words=[
+        [word, format_score(score)] for word, score in result['words']
+    ])
+
+
+def api_job(job):
+    description = {'id': job.id, 'status': job.status()}
+
+    if description['status'] == DONE:
+        description.update(api_result(job.result()))
+    elif description['status'] == FAILED:
+        description['error'] = job.error()
+
+    return description
+
+
+@app.route('/api/words', methods=['POST'])
+def api_words():
+    """
+    Return the best words to play on a grid as JSON, given either a
+    screenshot or the grid's letters and ownership, along with an optional
+    limit, priority and language.
+    """
+
+    try:
+        result = solve(*api_request(api_params()))
+    except (BadRequestError, LPImageException) as e:
+        return jsonify({'error': str(e)}), 400
+    except OSError:
+        # PIL couldn't make anything of it (UnidentifiedImageError is one of
+        # these)
+        return jsonify({'error': UNREADABLE_IMAGE_ERROR}), 400
+
+    return jsonify(api_result(result))
+
+
+@app.route('/api/jobs', methods=['POST'])
+def api_jobs():
+    """
+    Queue up the same work as api_words() and return the ID of the job doing
+    it, which can be checked on with api_job_result().
+    """
+
+    queue = get_job_queue()
+
+    if queue is None:
+        abort(404)
+
+    try:
+        job = queue.submit(solve, *api_request(api_params()))
+    except BadRequestError as e:
+        return jsonify({'error': str(e)}), 400
+    except QueueFullError:
+        return jsonify({'error': BUSY_ERROR}), 503, {
+            'Retry-After': str(RETRY_AFTER),
+        }
+
+    return jsonify(api_job(job)), 202, {
+        'Location': url_for('api_job_result', job_id=job.id),
+    }
+
+
+@app.route('/api/jobs/<job_id>')
+def api_job_result(job_id):
+    """
+    Return the status of a job, and its result if it's finished. If wait is
+    given, wait up to that many seconds for it to finish first.
+    """
+
+    queue = get_job_queue()
+
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        wait = 0
+
+    job = queue.get(job_id, wait) if queue is not None else None
+
+    if job is None:
+        return jsonify({'error': 'no such job'}), 404
+
+    return jsonify(api_job(job))
+
+
+@app.route('/metrics')
+def metrics_totals():
+    """
+    Return everything this process has traced so far as JSON, if we're
+    tracing, we've been asked to and this request is from the same machine.
+    """
+
+    if (
+        not (metrics.ENABLED and METRICS_ENDPOINT) or
+        request.remote_addr not in LOCAL_ADDRESSES
+    ):
+        abort(404)
+
+    return jsonify(metrics.totals.as_dict())
+
+
+metrics.configure_logging()
+
+
+def serve(address, workers=None, debug=False):
+    """
+    Serve the web app on address with gunicorn, or with Flask's own
+    development server if debug is set or gunicorn isn't installed.
+    """
+
     if ':' in address:
         host, port = address.split(':', 1)
     else:
         port = address
         host = '127.0.0.1'
 
-    app.run(host=host, port=int(port), debug=True)
-    print(address)
+    if not debug:
+        try:
+            from lp.wsgi import serve as serve_with_gunicorn
+        except ImportError:
+            print(
+                "gunicorn isn't installed, so we're only serving from one "
+                "process", file=sys.stderr,
+            )
+        else:
+            serve_with_gunicorn(app, '{}:{}'.format(host, port), workers)
+            return
+
+    app.run(host=host, port=int(port), debug=debug, threaded=True)
 
 
 application = app
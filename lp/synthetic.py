@@ -0,0 +1,482 @@
+"""
+Making fake screenshots of games, as many as we like, for when the handful in
+lp/tests/images aren't enough to tell how quickly or how well we read them.
+
+Usage:
+  python -m lp.synthetic [--count=COUNT] [--seed=SEED] [--workers=WORKERS]
+                         [--check] DIRECTORY
+
+Renders COUNT (by default 1000) random grids into DIRECTORY in random themes
+and at random resolutions, some of them with wiggling tiles and some of them
+saved as JPEGs. Each one is saved as DIRECTORY/LETTERS_OWNERSHIP/NAME, the same
+way the screenshots in lp/tests/images are, where NAME says how it was
+rendered. The same SEED (by default 0) always renders the same screenshots.
+
+With --check, every screenshot in DIRECTORY (including ones that were already
+there, so --count=0 --check lp/tests/images works too) is then read back, and
+how many we read correctly and how quickly we read them is printed as JSON.
+"""
+
+from collections import Counter
+from functools import lru_cache, partial
+import json
+from multiprocessing import Pool
+import os
+import random
+import sys
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+from lp.batch import expand_paths
+from lp.dictionary import ALPHABET
+from lp.game import Board, GRID_SIZE, NOBODY, OPPONENT, PLAYER
+from lp.image import IMAGES_DIR, THEMES, parse_image
+
+
+FONT_PATH = os.path.join(IMAGES_DIR, 'MuseoSansRounded700.otf')
+
+# in the same order as THEMES
+THEME_NAMES = (
+    'light', 'pop', 'retro', 'dark', 'forest', 'glow', 'pink', 'contrast',
+)
+
+# the width and height of the screens we pretend to be, how much of the
+# bottom of each is taken up by something other than the game, and what
+NAV_BAR = 'nav bar'
+HOME_INDICATOR = 'home indicator'
+SCREENS = (
+    (640, 1136, 0, None),
+    (750, 1334, 0, None),
+    (720, 1280, 86, NAV_BAR),
+    (1080, 1920, 130, NAV_BAR),
+    (1242, 2208, 0, None),
+    (1125, 2436, 132, HOME_INDICATOR),
+    (1170, 2532, 138, HOME_INDICATOR),
+)
+
+# the height of a capital letter, and where its middle is, as fractions of
+# the height of its tile
+LETTER_HEIGHT = 0.45
+LETTER_MIDDLE = 0.47
+# how much lighter (or darker, for dark themes) than the unclaimed colour the
+# background is, how much darker (or lighter) than the background unclaimed
+# tiles are, and how much more so every other one of those is
+BACKGROUND_SHADE = 4
+UNCLAIMED_SHADE = 7
+CHECKERBOARD_SHADE = 3
+# how far each channel of a theme's colours can be off by, since no two
+# phones show them quite the same
+COLOUR_JITTER = 6
+# which of the colours in each theme have light letters on them, rather than
+# dark ones, in the same order as THEMES
+LIGHT_LETTERS = (
+    (False, False, False, False, False),
+    (False, True, True, True, False),
+    (False, False, False, False, True),
+    (False, True, True, True, False),
+    (True, False, False, False, False),
+    (False, True, True, False, False),
+    (True, False, False, False, False),
+    (True, False, False, False, False),
+)
+# how far letters are from black (or white) towards the colour of their tile
+LETTER_TINT = 0.2
+
+# how likely a screenshot is to have been taken while tiles were still
+# wiggling, and how far wiggling tiles can be turned (in degrees) and moved
+# (as a fraction of their size)
+WIGGLE_CHANCE = 0.2
+WIGGLE_ANGLE = 4
+WIGGLE_OFFSET = 0.04
+# how likely a screenshot is to be a JPEG, and how bad that JPEG can be
+JPEG_CHANCE = 0.5
+JPEG_QUALITY = (60, 95)
+
+DEFAULT_COUNT = 1000
+DEFAULT_SEED = 0
+# screenshots are handed to workers this many at a time
+CHUNK_SIZE = 16
+
+
+@lru_cache()
+def font(size):
+    return ImageFont.truetype(FONT_PATH, size)
+
+
+@lru_cache(maxsize=1024)
+def glyph(letter, tile_size):
+    """
+    Return a mask of letter, cropped to its edges, the size it'd be drawn on
+    a tile tile_size pixels across.
+    """
+
+    cap_height = font(100).getbbox('H')
+    size = round(
+        100 * LETTER_HEIGHT * tile_size / (cap_height[3] - cap_height[1])
+    )
+
+    mask = Image.new('L', (tile_size * 2, tile_size * 2))
+    ImageDraw.Draw(mask).text((0, 0), letter, font=font(size), fill=255)
+    return mask.crop(mask.getbbox())
+
+
+def luma(colour):
+    r, g, b = colour
+    return 0.299 * r + 0.587 * g + 0.114 * b
+
+
+def letter_colour(colour, light):
+    if light:
+        return tuple(round(255 - (255 - c) * LETTER_TINT) for c in colour)
+    return tuple(round(c * LETTER_TINT) for c in colour)
+
+
+def shade(colour, amount):
+    return tuple(min(max(c + amount, 0), 255) for c in colour)
+
+
+def random_grid(rng):
+    """
+    Return the letters and ownership of a random grid, with tiles clumped
+    together like they are in a real game, so that some of them are
+    defended.
+    """
+
+    letters = ''.join(rng.choice(ALPHABET) for _ in range(GRID_SIZE ** 2))
+    ownership = [
+        rng.choice((NOBODY, OPPONENT, PLAYER)) for _ in range(GRID_SIZE ** 2)
+    ]
+
+    for i in rng.sample(range(GRID_SIZE ** 2), GRID_SIZE ** 2 // 2):
+        row, column = divmod(i, GRID_SIZE)
+        neighbours = [
+            r * GRID_SIZE + c for r, c in (
+                (row - 1, column), (row + 1, column),
+                (row, column - 1), (row, column + 1),
+            ) if 0 <= r < GRID_SIZE and 0 <= c < GRID_SIZE
+        ]
+        ownership[i] = ownership[rng.choice(neighbours)]
+
+    return letters, ''.join(ownership)
+
+
+def render_tile(letter, colour, light, size):
+    tile = Image.new('RGB', (size, size), colour)
+    mask = glyph(letter.upper(), size)
+    tile.paste(letter_colour(colour, light), (
+        (size - mask.width) // 2,
+        round(size * LETTER_MIDDLE - mask.height / 2),
+    ), mask)
+    return tile
+
+
+def render(letters, ownership, theme=0, screen=SCREENS[1], wiggling=(),
+           jitter=(0, 0, 0), rng=None):
+    """
+    Return a screenshot of the grid described by letters and ownership, in
+    the theme at that index of THEMES, taken on screen (one of SCREENS).
+
+    The tiles at the indices in wiggling are drawn turned and moved by a
+    random amount, as if they'd just been played, and every colour is
+    shifted by jitter.
+    """
+
+    rng = rng or random.Random()
+    width, height, bottom, furniture = screen
+    colours = [
+        tuple(min(max(c + j, 0), 255) for c, j in zip(colour, jitter))
+        for colour in THEMES[theme]
+    ]
+    unclaimed = colours[2]
+    # which way is further away from the background
+    direction = -1 if luma(unclaimed) > 127 else 1
+    background = shade(unclaimed, -direction * BACKGROUND_SHADE)
+    ink = letter_colour(unclaimed, LIGHT_LETTERS[theme][2])
+
+    image = Image.new('RGB', (width, height), background)
+    draw = ImageDraw.Draw(image)
+    grid_top = height - bottom - width
+
+    # the bits of the game above the grid
+    scores = Counter(ownership)
+    unit = width / 100
+    draw.line((4 * unit, 7 * unit, 10 * unit, 7 * unit), ink, round(unit))
+    for y in (5, 7, 9):
+        draw.line((90 * unit, y * unit, 96 * unit, y * unit), ink, round(unit))
+
+    avatar_middle = grid_top - 46 * unit
+    for x, colour, score in (
+        (37, colours[3], scores[PLAYER]), (63, colours[1], scores[OPPONENT]),
+    ):
+        draw.ellipse((
+            (x - 11) * unit, avatar_middle - 11 * unit,
+            (x + 11) * unit, avatar_middle + 11 * unit,
+        ), colour)
+        draw.text(
+            (x * unit, grid_top - 30 * unit), str(score), ink,
+            font(round(9 * unit)), anchor='mm',
+        )
+
+    if furniture == NAV_BAR:
+        draw.rectangle((0, height - bottom, width, height), (0, 0, 0))
+    elif furniture == HOME_INDICATOR:
+        draw.rounded_rectangle((
+            33 * unit, height - bottom / 4 - unit / 2,
+            67 * unit, height - bottom / 4 + unit / 2,
+        ), unit / 2, ink)
+
+    # and then the grid itself
+    defended = Board.from_ownership(letters, ownership).defended()
+    edges = [round(i * width / GRID_SIZE) for i in range(GRID_SIZE + 1)]
+    moved = []
+
+    for i, (letter, owner) in enumerate(zip(letters, ownership)):
+        row, column = divmod(i, GRID_SIZE)
+
+        if owner == NOBODY:
+            slot = 2
+        elif defended >> i & 1:
+            slot = 0 if owner == OPPONENT else 4
+        else:
+            slot = 1 if owner == OPPONENT else 3
+
+        colour = colours[slot]
+        if owner == NOBODY:
+            colour = shade(background, direction * (
+                UNCLAIMED_SHADE + CHECKERBOARD_SHADE * ((row + column) % 2)
+            ))
+
+        left, top = edges[column], grid_top + edges[row]
+        tile = render_tile(
+            letter, colour, LIGHT_LETTERS[theme][slot],
+            edges[column + 1] - left,
+        )
+
+        if i in wiggling:
+            moved.append((tile, left, top))
+        else:
+            image.paste(tile, (left, top))
+
+    # tiles that are wiggling end up on top of the ones that aren't
+    for tile, left, top in moved:
+        size = tile.width
+        tile = tile.convert('RGBA').rotate(
+            rng.uniform(-WIGGLE_ANGLE, WIGGLE_ANGLE),
+            resample=Image.BICUBIC, expand=True,
+        )
+        offset = [
+            round(rng.uniform(-WIGGLE_OFFSET, WIGGLE_OFFSET) * size)
+            for _ in range(2)
+        ]
+        image.paste(tile, (
+            left + offset[0] - (tile.width - size) // 2,
+            top + offset[1] - (tile.height - size) // 2,
+        ), tile)
+
+    return image
+
+
+def make_screenshot(directory, seed, index):
+    """
+    Render and save the index-th random screenshot for seed, and return the
+    path we saved it to.
+    """
+
+    rng = random.Random('{}:{}'.format(seed, index))
+    letters, ownership = random_grid(rng)
+    theme = rng.randrange(len(THEMES))
+    screen = rng.choice(SCREENS)
+    wiggling = ()
+
+    if rng.random() < WIGGLE_CHANCE:
+        wiggling = set(rng.sample(
+            range(GRID_SIZE ** 2), rng.randint(1, GRID_SIZE * 2),
+        ))
+
+    image = render(
+        letters, ownership, theme, screen, wiggling, [
+            rng.randint(-COLOUR_JITTER, COLOUR_JITTER) for _ in range(3)
+        ], rng,
+    )
+
+    name = '-'.join(filter(None, (
+        THEME_NAMES[theme], '{}x{}'.format(*screen[:2]),
+        'wiggle' if wiggling else None, str(index),
+    )))
+    path = os.path.join(directory, '{}_{}'.format(letters, ownership), name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if rng.random() < JPEG_CHANCE:
+        path += '.jpg'
+        image.save(path, format='JPEG', quality=rng.randint(*JPEG_QUALITY))
+    else:
+        # it's the pixels that matter, not how small the file is
+        path += '.png'
+        image.save(path, format='PNG', compress_level=1)
+
+    return path
+
+
+def generate(directory, count=DEFAULT_COUNT, seed=DEFAULT_SEED, workers=None):
+    """
+    Save count random screenshots to directory, and yield their paths as
+    they're saved.
+    """
+
+    with Pool(workers) as pool:
+        yield from pool.imap_unordered(
+            partial(make_screenshot, directory, seed), range(count),
+            chunksize=CHUNK_SIZE,
+        )
+
+
+def ground_truth(path):
+    """
+    Return the letters and ownership of the grid in the screenshot at path,
+    going by its name or the name of the directory it's in, or None if
+    neither of those say.
+    """
+
+    for name in (
+        os.path.basename(path), os.path.basename(os.path.dirname(path)),
+    ):
+        letters, _, ownership = os.path.splitext(name)[0].partition('_')
+        if len(letters) == len(ownership) == GRID_SIZE ** 2:
+            return letters.lower(), ownership
+
+    return None
+
+
+def read(path):
+    """
+    Return path, what we read from the screenshot there (or why we couldn't),
+    and how long that took.
+    """
+
+    started = time.perf_counter()
+
+    try:
+        letters, ownership = parse_image(path)
+        result = '{}_{}'.format(letters.lower(), ownership)
+    except Exception as e:
+        # whatever goes wrong, it's a screenshot we didn't read
+        result = '{}: {}'.format(type(e).__name__, e)
+
+    return path, result, time.perf_counter() - started
+
+
+def tags_for(path):
+    """
+    Return the ways in which the screenshot at path was rendered, going by
+    its name, to break results down by.
+    """
+
+    name, extension = os.path.splitext(os.path.basename(path))
+    return name.split('-')[:-1] + [extension.lstrip('.').lower()]
+
+
+def check(paths, workers=None):
+    """
+    Read every one of paths that has a ground truth, and return a summary of
+    how well and how quickly we did it.
+    """
+
+    expected = {}
+    for path in paths:
+        truth = ground_truth(path)
+        if truth is not None:
+            expected[path] = '{}_{}'.format(*truth)
+
+    images = Counter()
+    correct = Counter()
+    failures = []
+    reading = 0
+    started = time.perf_counter()
+
+    with Pool(workers) as pool:
+        for path, result, elapsed in pool.imap_unordered(
+            read, sorted(expected), chunksize=CHUNK_SIZE,
+        ):
+            reading += elapsed
+            right = result == expected[path]
+
+            for tag in [None] + tags_for(path):
+                images[tag] += 1
+                correct[tag] += right
+
+            if not right:
+                failures.append({
+                    'path': path, 'expected': expected[path], 'read': result,
+                })
+
+    seconds = time.perf_counter() - started
+
+    return {
+        'images': images[None],
+        'correct': correct[None],
+        'accuracy': correct[None] / images[None] if images[None] else None,
+        'seconds': seconds,
+        'images_per_second': images[None] / seconds if seconds else None,
+        'mean_read_time': reading / images[None] if images[None] else None,
+        'accuracy_by_tag': {
+            tag: correct[tag] / images[tag] for tag in images if tag
+        },
+        'failures': sorted(failures, key=lambda f: f['path']),
+    }
+
+
+def print_docs_and_exit():
+    print(__doc__.strip())
+    sys.exit(1)
+
+
+def main(args):
+    options = {}
+    directory = None
+
+    for arg in args:
+        name, _, value = arg.partition('=')
+
+        if not arg.startswith('--'):
+            if directory is not None:
+                print_docs_and_exit()
+            directory = arg
+        elif name == '--check' and not value:
+            options['check'] = True
+        elif name in ('--count', '--seed', '--workers') and value:
+            options[name[2:]] = value
+        else:
+            print_docs_and_exit()
+
+    if directory is None:
+        print_docs_and_exit()
+
+    try:
+        count = int(options.get('count', DEFAULT_COUNT))
+        seed = int(options.get('seed', DEFAULT_SEED))
+        workers = int(options['workers']) if 'workers' in options else None
+    except ValueError:
+        print_docs_and_exit()
+
+    results = {}
+
+    if count:
+        started = time.perf_counter()
+        generated = sum(1 for _ in generate(directory, count, seed, workers))
+        seconds = time.perf_counter() - started
+        results['generated'] = {
+            'images': generated,
+            'seconds': seconds,
+            'images_per_second': generated / seconds,
+        }
+
+    if options.get('check'):
+        results['checked'] = check(list(expand_paths([directory])), workers)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,12 +1,32 @@
+from io import BytesIO
+import json
 import os
-from tempfile import mktemp
+import random
+import time
+from tempfile import mkdtemp, mktemp
 from unittest import TestCase
+from unittest.mock import patch
 
 from PIL import Image
 
-from lp.game import Grid
+from lp.dictionary import Dictionary, get_dictionary
+from lp.game import Board, Grid, NOBODY, PLAYER
+from lp.batch import expand_paths, format_score, solve_all
+from lp.cache import ParseCache, SYMMETRIES, SolveCache
+from lp import metrics
+from lp.jobs import (
+    DONE, FAILED, JOB_ERROR, JobQueue, QueueFullError, solve,
+)
+from lp.search import Search
+from lp.synthetic import (
+    SCREENS, ground_truth, make_screenshot, random_grid, render,
+)
 from lp.image import (
-    LPImageException,
+    BACKGROUNDS, LETTER_INVARIANTS_HEADER, LETTER_INVARIANTS_PATH,
+    LPImageException, OWNER_TABLES, OWNERS, PACKED_LETTER_INVARIANTS,
+    THEME_OWNERS, THEMES, build_letter_invariants, closest_colour,
+    colour_table_index, parse_image, read_letter_invariants,
+    write_letter_invariants,
     TOO_LITTLE_CONFIDENCE_ERROR, NOT_NARROW_ENOUGH_ERROR, GRID_NOT_FOUND_ERROR,
     UNCLEAN_TILE_ERROR,
 )
@@ -68,6 +88,392 @@ class LPTest(TestCase):
                 image.save(jpg_path, format='JPEG', quality=80)
             self.assert_image_matches(letters, ownership, jpg_path)
 
+    def test_playable_words_match_scan(self):
+        for letters, engine in (
+            (letters, engine) for letters in (
+                'casontelbdlratbcthydrcnee',
+                'uekyygslzkcosddhagoetzwai',
+                'eeeeeeeeeeeeeeeeeeeeeeeee',
+            ) for engine in Grid.ENGINES
+        ):
+            grid = Grid(letters, NOBODY * len(letters), engine=engine)
+            self.assertEqual(
+                list(grid.get_playable_words()),
+                [
+                    w for w in get_dictionary().words
+                    if grid.word_is_playable(w)
+                ],
+            )
+
+    def test_unique_playable_words(self):
+        def with_prefixes_blocked(playable):
+            playable = sorted(playable, key=lambda w: len(w), reverse=True)
+            blocked = set()
+
+            for word in playable:
+                if word not in blocked:
+                    yield word
+
+                for i in range(1, len(word)):
+                    blocked.add(word[:i])
+
+        rng = random.Random(0)
+
+        for letters, ownership in [random_grid(rng) for _ in range(3)]:
+            grid = Grid(letters, ownership)
+            playable = list(grid.get_playable_words())
+            playable += playable[::7] + ['']
+
+            with patch.object(grid, 'get_playable_words', lambda: playable):
+                self.assertEqual(
+                    list(grid.get_unique_playable_words()),
+                    list(with_prefixes_blocked(playable)),
+                )
+
+    def test_defence_follows_ownership(self):
+        grid = Grid('abcdefghijklmnopqrstuvwxy', 'ppuuupuuuuuuuuuuuuuuuuuuu')
+        self.assertTrue(grid.tiles[0].is_defended())
+        self.assertEqual(grid.player_score(), 3)
+
+        grid.tiles[1].ownership = NOBODY
+        self.assertFalse(grid.tiles[0].is_defended())
+        self.assertEqual(grid.player_score(), 2)
+
+        grid.tiles[1].ownership = PLAYER
+        self.assertTrue(grid.tiles[0].is_defended())
+
+    def test_board_play(self):
+        board = Board.from_ownership(
+            'abcdefghijklmnopqrstuvwxy', 'oouuuouuuuuuuuuuuuupuuupp',
+        )
+        self.assertEqual(board.defended(), 1 | (1 << 24))
+
+        # the defended tile in the corner can't be taken, but the others can
+        played = board.play(0b111)
+        self.assertEqual(played.ownership(), 'oppuuouuuuuuuuuuuuupuuupp')
+        self.assertEqual(
+            (played.player_score(), played.opponent_score()), (5, 2),
+        )
+        self.assertEqual(played.swapped().swapped(), played)
+        self.assertEqual(Grid.from_board(played).get_board(), played)
+
+    def test_best_tiles(self):
+        # taking the a in the top row breaks our opponent's defence of the
+        # corner, which makes it better than the unclaimed a at the bottom
+        grid = Grid(
+            'bacdefghijklmnopqrstuvwxa', 'oouuuoouuuuuuuuuuuuuuuuuu',
+            priority=Grid.BEST_TILES_PRIORITY,
+        )
+        self.assertEqual(grid.get_best_tiles('a'), (1 << 1, 3))
+        self.assertEqual(grid.get_best_tiles('ab'), (1 << 1, 3))
+        self.assertEqual(grid.get_best_tiles('aa'), ((1 << 1) | (1 << 24), 4))
+
+    def test_top_words(self):
+        rng = random.Random(0)
+        boards = [
+            ('uekyygslzkcosddhagoetzwai', 'oooopooouuoooppoopppopupp'),
+            # a short word that claims every unclaimed tile wins ahead of a
+            # long one that takes more of our opponent's tiles too
+            ('ordnirrlhrlnpmggoancmbslo', 'oopuopppopppoooopoopopouo'),
+        ] + [random_grid(rng) for _ in range(5)]
+
+        for letters, ownership in boards:
+            for priority in Grid.PRIORITY_VALUES:
+                grid = Grid(letters, ownership, priority=priority)
+                best_words = grid.get_best_words()
+
+                for count in (1, 10, 50):
+                    self.assertEqual(
+                        grid.get_top_words(count), best_words[:count],
+                    )
+
+    def test_lookahead_keeps_to_budget(self):
+        grid = Grid('cunkjzoonwseixyfnmaoquhdn', NOBODY * 25)
+        words = list(grid.get_unique_playable_words())
+        search = Search(grid.get_board(), words, depth=4, time_budget=0.5)
+
+        started = time.monotonic()
+        ranked = search.rank()
+        self.assertLess(time.monotonic() - started, 2 * search.time_budget)
+        self.assertEqual(sorted(w for w, s in ranked), sorted(words))
+
+    def test_lookahead_last_tile(self):
+        # once we've played a, our opponent can't take y too without losing,
+        # but they can play a and leave it for us
+        grid = Grid('abcdefghijklmnopqrstuvwxy', PLAYER * 24 + NOBODY)
+        search = Search(grid.get_board(), ['ay', 'a'], depth=2)
+        self.assertEqual(search.rank(), [('ay', float('inf')), ('a', 0)])
+
+    def test_dictionary_cache(self):
+        cache_dir = mkdtemp()
+        words_path = os.path.join(cache_dir, 'words.txt')
+
+        with patch('lp.dictionary.CACHE_DIR', cache_dir):
+            for words in (['Cat', 'ACT', 'tact', ''], ['dog', 'do']):
+                with open(words_path, 'w') as wf:
+                    wf.write(''.join('{}\n'.format(w) for w in words))
+
+                built = Dictionary.load(words_path)
+                cached = Dictionary.load(words_path)
+
+                self.assertEqual(cached.words, [w.lower() for w in words])
+                self.assertEqual(
+                    cached.index.get_playable_words('catdog'),
+                    built.index.get_playable_words('catdog'),
+                )
+                self.assertEqual(
+                    cached.matrix.get_playable_words('catdog'),
+                    built.matrix.get_playable_words('catdog'),
+                )
+
+    def test_parse_cache(self):
+        cache_dir = mkdtemp()
+        letters, ownership, path = next(self.pngs())
+
+        key, parsed = ParseCache(directory=cache_dir).parse(path)
+        self.assertEqual((parsed[0].lower(), parsed[1]), (letters, ownership))
+
+        # a fresh cache sharing the same directory shouldn't need to parse it
+        with patch('lp.image.parse_image', side_effect=AssertionError):
+            cache = ParseCache(size=1, directory=cache_dir)
+            self.assertEqual(cache.parse(path), (key, parsed))
+            self.assertEqual(cache.get(key), parsed)
+            self.assertIsNone(cache.get('../' + key))
+
+    def test_solve_cache(self):
+        cache_dir = mkdtemp()
+        letters = 'uekyygslzkcosddhagoetzwai'
+        ownership = 'oooopooouuoooppoopppopupp'
+
+        for priority in (Grid.NET_SCORE_PRIORITY, Grid.BEST_TILES_PRIORITY):
+            grid = Grid(letters, ownership, priority=priority)
+            top_words = grid.get_top_words(10)
+            self.assertEqual(
+                SolveCache(directory=cache_dir).top_words(grid, 10), top_words,
+            )
+
+            # every rotation and reflection of a grid is the same grid, as
+            # far as a fresh cache sharing the same directory is concerned
+            with patch.object(
+                Grid, 'get_top_words', side_effect=AssertionError,
+            ):
+                cache = SolveCache(directory=cache_dir)
+
+                for symmetry in SYMMETRIES:
+                    transformed = Grid(
+                        ''.join(letters[i] for i in symmetry),
+                        ''.join(ownership[i] for i in symmetry),
+                        priority=priority,
+                    )
+                    self.assertEqual(
+                        cache.top_words(transformed, 5), top_words[:5],
+                    )
+
+    def test_api(self):
+        from lp.server import UNREADABLE_IMAGE_ERROR, app
+
+        client = app.test_client()
+        letters = 'uekyygslzkcosddhagoetzwai'
+        ownership = 'oooopooouuoooppoopppopupp'
+
+        response = client.post('/api/words', json={
+            'letters': letters, 'ownership': ownership, 'limit': 5,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['words'], [
+            [w, format_score(s)]
+            for w, s in Grid(letters, ownership).get_top_words(5)
+        ])
+
+        response = client.post('/api/words', json={
+            'letters': letters, 'priority': 'nonsense',
+        })
+        self.assertEqual(response.status_code, 400)
+
+        response = client.post('/api/words', json={
+            'letters': letters, 'priority': ['a'],
+        })
+        self.assertEqual(response.status_code, 400)
+
+        with open(__file__, 'rb') as f:
+            response = client.post('/api/words', data={'image': f})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.get_json())
+
+        with client.session_transaction() as session:
+            session['_csrf_token'] = 'token'
+        with open(__file__, 'rb') as f:
+            response = client.post('/', data={
+                'image': f, '_csrf_token': 'token',
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            UNREADABLE_IMAGE_ERROR.replace("'", '&#39;'),
+            response.get_data(as_text=True),
+        )
+
+    def test_batch(self):
+        errors_dir = os.path.join(IMAGE_DIR, 'errors')
+        errors = sorted(
+            os.path.join(errors_dir, f) for f in os.listdir(errors_dir)
+        )
+        good = os.path.join(
+            IMAGE_DIR,
+            'casontelbdlratbcthydrcnee_pppooppppooopoooooppooooo.png',
+        )
+        missing = os.path.join(IMAGE_DIR, 'missing.png')
+
+        paths = list(expand_paths([
+            errors_dir, os.path.join(IMAGE_DIR, 'casontel*.png'), missing,
+        ]))
+        self.assertEqual(paths, errors + [good, missing])
+
+        results = {}
+        for line in solve_all(paths, workers=1, count=5):
+            result = json.loads(line)
+            results[result['path']] = result
+
+        self.assertEqual(set(results), set(paths))
+
+        for path in errors + [missing]:
+            self.assertIn('error', results[path])
+            self.assertNotIn('words', results[path])
+
+        self.assertNotIn('error', results[good])
+        self.assertEqual(results[good]['letters'], 'casontelbdlratbcthydrcnee')
+        self.assertEqual(len(results[good]['words']), 5)
+
+    def test_job_queue(self):
+        queue = JobQueue(1, max_pending=1)
+        letters = 'uekyygslzkcosddhagoetzwai'
+        ownership = 'oooopooouuoooppoopppopupp'
+
+        try:
+            job = queue.submit(
+                solve, letters, ownership, None, Grid.NET_SCORE_PRIORITY,
+                None, 5,
+            )
+            self.assertIs(queue.get(job.id, timeout=10), job)
+            self.assertEqual(job.status(), DONE)
+            self.assertEqual(
+                job.result()['words'],
+                Grid(letters, ownership).get_top_words(5),
+            )
+
+            # a file that isn't an image at all isn't our fault, and
+            # shouldn't stop anyone checking on it
+            queue.max_pending = 2
+            with patch('lp.jobs.logger'):
+                job = queue.submit(
+                    solve, None, None, b'not an image',
+                    Grid.NET_SCORE_PRIORITY, None, 5,
+                )
+                queue.get(job.id, timeout=10)
+                self.assertEqual(job.status(), FAILED)
+                self.assertEqual(job.error(), JOB_ERROR)
+
+            queue.max_pending = 0
+            with self.assertRaises(QueueFullError):
+                queue.submit(time.sleep, 0)
+        finally:
+            queue.shutdown()
+
+    def test_metrics(self):
+        letters, ownership, path = next(self.pngs())
+
+        self.assertIsNone(metrics.start_trace('disabled'))
+
+        with patch('lp.metrics.ENABLED', True):
+            with metrics.trace('test') as trace:
+                Grid(*parse_image(path)).get_top_words(5)
+
+                # nothing can trace something that's already being traced
+                self.assertIsNone(metrics.start_trace('nested'))
+
+        self.assertIsNone(metrics.current_trace())
+        self.assertLessEqual(sum(trace.stages.values()), trace.total)
+        self.assertEqual(set(trace.stages), {
+            'decode', 'top_of_grid', 'tiles', 'match', 'playable_words',
+            'unique_words', 'rank',
+        })
+        self.assertGreaterEqual(
+            trace.counters['playable_words'], trace.counters['unique_words'],
+        )
+        self.assertGreaterEqual(
+            trace.counters['unique_words'], trace.counters['scored_words'],
+        )
+        self.assertGreaterEqual(trace.counters['scored_words'], 5)
+
+        from lp.server import app
+
+        client = app.test_client()
+
+        with patch('lp.metrics.ENABLED', True):
+            self.assertEqual(client.get('/metrics').status_code, 404)
+
+            with patch('lp.server.METRICS_ENDPOINT', True):
+                self.assertEqual(client.get('/metrics').status_code, 200)
+
+    def test_letter_invariants(self):
+        # the bundled matrices are the ones we'd build from the letter images
+        # we have, so nobody's been left to rebuild them on import
+        built = build_letter_invariants()
+        self.assertTrue((built == PACKED_LETTER_INVARIANTS).all())
+        self.assertTrue(
+            (read_letter_invariants() == PACKED_LETTER_INVARIANTS).all(),
+        )
+
+        # matrices built from different letter images can't be trusted
+        with open(LETTER_INVARIANTS_PATH, 'rb') as f:
+            data = bytearray(f.read())
+        data[LETTER_INVARIANTS_HEADER.size - 1] ^= 0xff
+
+        path = os.path.join(mkdtemp(), 'letters.bin')
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.assertIsNone(read_letter_invariants(path))
+
+        # but rewriting them fixes that
+        write_letter_invariants(built, path)
+        self.assertTrue((read_letter_invariants(path) == built).all())
+
+    def test_owner_tables(self):
+        rng = random.Random(0)
+
+        for background, table in zip(BACKGROUNDS, OWNER_TABLES):
+            colours = {
+                colour: owner
+                for theme in THEMES if theme[2] == background
+                for colour, owner in zip(theme, THEME_OWNERS)
+            }
+
+            for colour in list(colours) * 20:
+                noisy = tuple(
+                    min(max(c + rng.randint(-20, 20), 0), 255) for c in colour
+                )
+                self.assertEqual(
+                    OWNERS[table[colour_table_index(noisy)]],
+                    colours[closest_colour(noisy, colours)],
+                )
+
+    def test_synthetic(self):
+        rng = random.Random(0)
+
+        for theme in range(len(THEMES)):
+            letters, ownership = random_grid(rng)
+            image = BytesIO()
+            render(letters, ownership, theme, SCREENS[theme % len(SCREENS)],
+                   wiggling={0, 12}, rng=rng).save(image, format='PNG')
+            image.seek(0)
+
+            self.assertEqual(
+                parse_image(image), (letters.upper(), ownership),
+            )
+
+        path = make_screenshot(mkdtemp(), 0, 0)
+        letters, ownership = parse_image(path)
+        self.assertEqual(ground_truth(path), (letters.lower(), ownership))
+
     def assert_image_raises_error(self, image, error, message):
         with self.assertRaises(error) as cm:
             self.assert_image_matches('', '', os.path.join(
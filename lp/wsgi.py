@@ -0,0 +1,99 @@
+"""
+Serving the web app with gunicorn, across several worker processes.
+
+Everything the workers need is loaded before they're forked, so that each of
+them starts up quickly and they all share the same copy of the word lists and
+letter templates rather than each loading their own.
+
+Anything else a worker remembers is its own, though. Jobs only exist in the
+process that queued them, so with the job queue enabled we serve from a single
+process with a thread per worker instead (which also keeps anyone waiting on
+a job from holding everyone else up). Screenshots can be re-solved by their
+hash from any worker, so unless LP_PARSE_CACHE_DIR says where, the workers
+share what they've read through a temporary directory.
+"""
+
+import gc
+from importlib import import_module
+from multiprocessing import cpu_count
+import os
+import shutil
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+from lp.cache import ParseCache, get_parse_cache, set_cache
+from lp.dictionary import available_languages, get_dictionary
+from lp.game import Grid
+from lp.jobs import JOB_WORKERS, shutdown_job_queue
+
+
+DEFAULT_WORKERS = int(os.environ.get('LP_WORKERS') or 0) or cpu_count()
+# how long, in seconds, workers get to finish what they're doing when we're
+# asked to stop
+GRACEFUL_TIMEOUT = 30
+# how long, in seconds, a worker can spend on one request before it's killed
+TIMEOUT = 60
+
+
+def preload():
+    # importing lp.image builds the letter templates
+    import_module('lp.image')
+
+    for language in available_languages():
+        dictionary = get_dictionary(language)
+        dictionary.index
+
+        if os.environ.get('LP_ENGINE', '').lower() == Grid.NUMPY_ENGINE:
+            dictionary.matrix
+
+    if hasattr(gc, 'freeze'):
+        # keep the garbage collector from touching (and so copying) all of
+        # the objects we just made in every worker
+        gc.freeze()
+
+
+def worker_exit(server, worker):
+    shutdown_job_queue()
+
+
+class Server(BaseApplication):
+    def __init__(self, app, options):
+        self.app = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.app
+
+
+def serve(app, bind, workers=None):
+    workers = workers or DEFAULT_WORKERS
+    options = {
+        'bind': bind,
+        'workers': workers,
+        'preload_app': True,
+        'timeout': TIMEOUT,
+        'graceful_timeout': GRACEFUL_TIMEOUT,
+        'worker_exit': worker_exit,
+    }
+
+    if JOB_WORKERS:
+        options.update({
+            'workers': 1,
+            'worker_class': 'gthread',
+            'threads': workers,
+        })
+    elif workers > 1 and get_parse_cache().directory is None:
+        directory = tempfile.mkdtemp(prefix='lp-parse-cache-')
+        set_cache(ParseCache(directory=directory))
+        options['on_exit'] = lambda server: shutil.rmtree(
+            directory, ignore_errors=True,
+        )
+
+    preload()
+    Server(app, options).run()
@@ -24,6 +24,9 @@ setup(
         'opencv-python',
         'pillow',
     ],
+    extras_require={
+        'server': ['gunicorn'],
+    },
     tests_require=[
         'nose',
     ],